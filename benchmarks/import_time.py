@@ -0,0 +1,84 @@
+"""Check that importing bikeride stays within its import time budget.
+
+Usage:
+    python benchmarks/import_time.py
+
+Each import is timed in fresh interpreters (best of several runs), after a
+setup that isn't timed, and checked against its budget; modules that
+should be loaded lazily must not be imported. The exit status is 1 if any
+check fails.
+"""
+
+import argparse
+import json
+from pathlib import Path
+import subprocess
+import sys
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# setup, statement to time, budget (s) and modules that must not be loaded
+CHECKS = [
+    {
+        'setup': '',
+        'statement': 'import bikeride',
+        'budget': 0.05,
+        'lazy': ['numpy', 'pandas', 'fitdecode', 'requests', 'ipyleaflet'],
+    },
+    {
+        # pandas and numpy are needed to process rides, so they are not
+        # counted
+        'setup': 'import numpy, pandas',
+        'statement': 'from bikeride import BikeRide',
+        'budget': 0.2,
+        'lazy': ['fitdecode', 'requests', 'ipyleaflet'],
+    },
+]
+SCRIPT = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+{setup}
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    'seconds': seconds,
+    'loaded': [name for name in {lazy!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure(check, repeat=5):
+    """Return best import time (s) of statement in fresh interpreters and
+    the lazy modules it loaded"""
+    results = []
+    for _ in range(repeat):
+        script = SCRIPT.format(root=str(ROOT), **check)
+        output = subprocess.run(
+            [sys.executable, '-c', script],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        results.append(json.loads(output))
+    return min(r['seconds'] for r in results), results[0]['loaded']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    failed = False
+    for check in CHECKS:
+        seconds, loaded = measure(check, args.repeat)
+        ok = seconds <= check['budget'] and not loaded
+        failed = failed or not ok
+        print(
+            f'{"ok  " if ok else "FAIL"} {check["statement"]:<32} '
+            f'{seconds:7.3f} s (budget {check["budget"]} s)'
+            + (f'; loaded {", ".join(loaded)}' if loaded else '')
+        )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
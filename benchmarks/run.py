@@ -0,0 +1,248 @@
+"""Time and memory-profile the stages of processing synthetic rides.
+
+Usage:
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --compare benchmarks/baseline.json
+
+Results are written as json, with the best wall time (s) of several runs
+and the peak memory allocated (bytes) for each stage and size tier. If a
+baseline is passed, stages that are slower than the baseline by more than
+the tolerance factor are reported and the exit status is 1.
+"""
+
+import argparse
+import json
+from pathlib import Path
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import numpy as np
+import pandas as pd
+from bikeride import BikeRide
+from bikeride.knmi import process_knmi
+from bikeride.plot import get_leaflet
+from bikeride.segments import build_segments
+from bikeride.track import Track
+from bikeride.weather import index_weather, join_weather
+import synthetic
+
+
+# number of records and days of KNMI data for each size tier
+TIERS = {
+    'small': {'records': 1_000, 'knmi_days': 31},
+    'medium': {'records': 10_000, 'knmi_days': 365},
+    'large': {'records': 100_000, 'knmi_days': 3650},
+}
+
+
+def create_files(directory, tier, interval):
+    """Write synthetic gps files, weather csvs and KNMI text for tier and
+    return their paths."""
+    track = synthetic.make_track(TIERS[tier]['records'], interval)
+    paths = {
+        'gpx': directory / f'{tier}.gpx',
+        'fit': directory / f'{tier}.fit',
+        'weather_hour': directory / f'{tier}_weather_hour.csv',
+        'weather_minute': directory / f'{tier}_weather_minute.csv',
+        'knmi': directory / f'{tier}_knmi.txt',
+    }
+    synthetic.write_gpx(paths['gpx'], track)
+    synthetic.write_fit(paths['fit'], track)
+    synthetic.make_weather(track, 'h').to_csv(
+        paths['weather_hour'], index=False
+    )
+    synthetic.make_weather(track, 'min').to_csv(
+        paths['weather_minute'], index=False
+    )
+    end = pd.Timestamp('20210101') + pd.Timedelta(
+        days=TIERS[tier]['knmi_days'] - 1
+    )
+    paths['knmi'].write_text(
+        synthetic.make_knmi_text('20210101', end.strftime('%Y%m%d'))
+    )
+    return paths
+
+
+def get_stages(paths):
+    """Return dict with a function per stage that returns a function to
+    time, so that preparation is not timed."""
+    def ride(**kwargs):
+        ride = BikeRide(paths['fit'], lazy=True, **kwargs)
+        ride.get_stage('columns')
+        return ride
+
+    def parse(filetype):
+        return lambda: BikeRide(paths[filetype], lazy=True).get_stage(
+            'columns'
+        )
+
+    def track():
+        columns = ride().columns
+        return lambda: Track(columns)
+
+    def truncate():
+        r = ride()
+        track = r.track
+        n = len(track)
+        limits = [
+            (track['lat'][n // 10], track['lon'][n // 10]),
+            (track['lat'][9 * n // 10], track['lon'][9 * n // 10]),
+            20,
+        ]
+        return lambda: r.truncate(track, limits)
+
+    def segments():
+        track = ride().track
+        return lambda: build_segments(track)
+
+    def weather(freq):
+        segments = ride().segment_table
+        path = paths[f'weather_{freq}']
+        return lambda: join_weather(
+            segments, index_weather(pd.read_csv(path))
+        )
+
+    def summary():
+        r = ride(path_weather=paths['weather_hour'])
+        r.get_stage('segment_table')
+        r.get_stage('median_position')
+        return r.get_summary
+
+    def plot():
+        # ipyleaflet is imported on first use, which shouldn't be timed
+        get_leaflet()
+        r = ride()
+        r.get_stage('segment_table')
+        return r.plot
+
+    def knmi():
+        text = paths['knmi'].read_text()
+        return lambda: process_knmi(text)
+
+    return {
+        'parse_gpx': lambda: parse('gpx'),
+        'parse_fit': lambda: parse('fit'),
+        'track': track,
+        'truncate': truncate,
+        'segments': segments,
+        'weather_join_hour': lambda: weather('hour'),
+        'weather_join_minute': lambda: weather('minute'),
+        'summary': summary,
+        'plot': plot,
+        'knmi_parse': knmi,
+    }
+
+
+def measure(prepare, repeat, memory=True):
+    """Return best wall time (s) of repeat runs and peak memory (bytes)
+    allocated during one run (tracing allocations is slow, so this run is
+    not timed)."""
+    times = []
+    for _ in range(repeat):
+        func = prepare()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    if not memory:
+        return {'seconds': min(times), 'peak_bytes': None}
+    func = prepare()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': min(times), 'peak_bytes': peak}
+
+
+def run(tiers, interval=1, repeat=3, stages=None, memory=True):
+    """Run benchmarks and return results as dict"""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for tier in tiers:
+            paths = create_files(Path(directory), tier, interval)
+            results[tier] = {}
+            for stage, prepare in get_stages(paths).items():
+                if stages and stage not in stages:
+                    continue
+                result = measure(prepare, repeat, memory)
+                results[tier][stage] = result
+                line = f'{tier:<8} {stage:<20} {result["seconds"]:9.4f} s'
+                if memory:
+                    line += f' {result["peak_bytes"] / 2 ** 20:9.1f} MiB'
+                print(line, flush=True)
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+        },
+        'settings': {
+            'interval': interval, 'repeat': repeat, 'memory': memory,
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return list of stages that are slower than in baseline by more than
+    factor tolerance."""
+    regressions = []
+    for tier, stages in results['results'].items():
+        for stage, result in stages.items():
+            base = baseline['results'].get(tier, {}).get(stage)
+            if not base:
+                continue
+            ratio = result['seconds'] / base['seconds']
+            if ratio > tolerance:
+                regressions.append(
+                    f'{tier} {stage}: {result["seconds"]:.4f} s, '
+                    f'baseline {base["seconds"]:.4f} s ({ratio:.1f}x)'
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--tiers', nargs='+', choices=list(TIERS), default=list(TIERS)
+    )
+    parser.add_argument('--stages', nargs='+')
+    parser.add_argument(
+        '--interval', type=float, default=1,
+        help='seconds between records of synthetic rides',
+    )
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument(
+        '--no-memory', action='store_true',
+        help="don't measure peak memory, which is slow for large tiers",
+    )
+    parser.add_argument('--output', help='path to write results to')
+    parser.add_argument('--compare', help='path to baseline results')
+    parser.add_argument(
+        '--tolerance', type=float, default=1.5,
+        help='factor by which a stage may be slower than the baseline',
+    )
+    args = parser.parse_args()
+    results = run(
+        args.tiers, args.interval, args.repeat, args.stages,
+        not args.no_memory,
+    )
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + '\n')
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'Slower than baseline: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Generate synthetic rides, weather data and KNMI responses for benchmarks"""
+
+import struct
+import numpy as np
+import pandas as pd
+
+
+START = pd.Timestamp('2021-06-01 08:00', tz='UTC')
+START_POSITION = (52.3, 4.9)
+FIT_EPOCH = pd.Timestamp('1989-12-31', tz='UTC')
+# columns of KNMI hourly data; the parser ignores the last two header fields
+KNMI_COLUMNS = [
+    '# STN', 'YYYYMMDD', 'HH', 'DD', 'FH', 'FF', 'FX', 'T', 'T10N', 'TD',
+    'SQ', 'Q', 'DR', 'RH', 'P', 'VV', 'N', 'U', 'WW', 'IX', 'M', 'R', 'S',
+    'O', 'Y',
+]
+
+
+def make_track(n_records, interval=1, seed=0):
+    """Return dataframe with a random ride of n_records records, one every
+    interval seconds, at about 25 km/h, with columns timestamp, lat, lon,
+    altitude, distance, speed, cadence and temperature."""
+    rng = np.random.default_rng(seed)
+    heading = np.cumsum(rng.normal(0, 0.05, n_records))
+    step = 7 * interval
+    dlat = step * np.cos(heading) / 111_200
+    dlon = step * np.sin(heading) / (111_200 * np.cos(np.radians(52.3)))
+    return pd.DataFrame({
+        'timestamp': START + pd.to_timedelta(
+            np.arange(n_records) * interval, unit='s'
+        ),
+        'lat': START_POSITION[0] + np.cumsum(dlat),
+        'lon': START_POSITION[1] + np.cumsum(dlon),
+        'altitude': 10 + np.cumsum(rng.normal(0, 0.1 * interval, n_records)),
+        'distance': np.arange(n_records) * step,
+        'speed': np.full(n_records, 7.0),
+        'cadence': rng.integers(70, 95, n_records),
+        'temperature': rng.integers(15, 20, n_records),
+    })
+
+
+def write_gpx(path, track):
+    """Write track to .gpx file"""
+    times = track.timestamp.dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+    points = [
+        f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>{ele:.1f}</ele>'
+        f'<time>{time}</time><extensions><gpxtpx:TrackPointExtension>'
+        f'<gpxtpx:atemp>{temp}</gpxtpx:atemp><gpxtpx:cad>{cad}</gpxtpx:cad>'
+        f'</gpxtpx:TrackPointExtension></extensions></trkpt>'
+        for lat, lon, ele, time, temp, cad in zip(
+            track.lat, track.lon, track.altitude, times, track.temperature,
+            track.cadence,
+        )
+    ]
+    with open(path, 'w') as f:
+        f.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gpx creator="bikeride benchmarks" version="1.1" '
+            'xmlns="http://www.topografix.com/GPX/1/1" xmlns:gpxtpx='
+            '"http://www.garmin.com/xmlschemas/TrackPointExtension/v1">\n'
+            '<metadata><author><name>bikeride</name><link href="">'
+            '<text>bikeride benchmarks</text></link></author></metadata>\n'
+            '<trk><name>Ride</name><trkseg>\n'
+        )
+        f.write('\n'.join(points))
+        f.write('\n</trkseg></trk></gpx>\n')
+
+
+def make_crc_table():
+    """Return lookup table for the crc-16 used in .fit files"""
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = make_crc_table()
+
+
+def fit_crc(data, crc=0):
+    """Return crc-16 of bytes as used in .fit files"""
+    for byte in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def fit_definition(local, global_number, fields):
+    """Return .fit definition message for fields (number, size, base type)"""
+    message = struct.pack(
+        '<BBBHB', 0x40 | local, 0, 0, global_number, len(fields)
+    )
+    for number, size, base_type in fields:
+        message += struct.pack('<BBB', number, size, base_type)
+    return message
+
+
+def write_fit(path, track):
+    """Write track to .fit activity file with file_id, sport and record
+    messages."""
+    timestamps = (
+        (track.timestamp - FIT_EPOCH) // pd.Timedelta(seconds=1)
+    ).to_numpy()
+    body = fit_definition(0, 0, [(0, 1, 0x00), (1, 2, 0x84), (2, 2, 0x84),
+                                 (4, 4, 0x86)])
+    body += struct.pack('<BBHHI', 0, 4, 1, 2713, int(timestamps[0]))
+    body += fit_definition(1, 12, [(0, 1, 0x00)]) + struct.pack('<BB', 1, 2)
+    body += fit_definition(2, 20, [
+        (253, 4, 0x86), (0, 4, 0x85), (1, 4, 0x85), (2, 2, 0x84),
+        (5, 4, 0x86), (6, 2, 0x84), (4, 1, 0x02), (13, 1, 0x01),
+    ])
+    records = np.zeros(len(track), dtype=np.dtype([
+        ('header', '<u1'), ('timestamp', '<u4'), ('lat', '<i4'),
+        ('lon', '<i4'), ('altitude', '<u2'), ('distance', '<u4'),
+        ('speed', '<u2'), ('cadence', '<u1'), ('temperature', '<i1'),
+    ]))
+    semicircles = 2 ** 31 / 180
+    records['header'] = 2
+    records['timestamp'] = timestamps
+    records['lat'] = np.round(track.lat * semicircles)
+    records['lon'] = np.round(track.lon * semicircles)
+    records['altitude'] = np.round((track.altitude + 500) * 5)
+    records['distance'] = np.round(track.distance * 100)
+    records['speed'] = np.round(track.speed * 1000)
+    records['cadence'] = track.cadence
+    records['temperature'] = track.temperature
+    body += records.tobytes()
+    header = struct.pack('<BBHI4s', 14, 0x20, 2132, len(body), b'.FIT')
+    header += struct.pack('<H', fit_crc(header))
+    data = header + body
+    with open(path, 'wb') as f:
+        f.write(data + struct.pack('<H', fit_crc(data)))
+
+
+def make_weather(track, freq='h', seed=0):
+    """Return dataframe with weather data covering the ride, with date, hour
+    and (for freq 'min') minute columns."""
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(
+        track.timestamp.iloc[0].floor('D'),
+        track.timestamp.iloc[-1].ceil('D'),
+        freq=freq,
+    )
+    weather = pd.DataFrame({
+        'date': index.strftime('%Y%m%d'),
+        'hour': index.hour,
+    })
+    if freq == 'min':
+        weather['minute'] = index.minute
+    weather['wind_direction'] = rng.integers(0, 360, len(index))
+    weather['wind_speed'] = rng.uniform(0, 10, len(index)).round(1)
+    weather['temperature'] = rng.uniform(10, 25, len(index)).round(1)
+    return weather
+
+
+def make_knmi_text(start, end, station=240, seed=0):
+    """Return text in the format of a KNMI hourly data response for dates
+    start to end (yyyymmdd)."""
+    days = pd.date_range(start, end, freq='D')
+    n = len(days) * 24
+    rng = np.random.default_rng(seed)
+    dates = np.repeat(days.strftime('%Y%m%d'), 24)
+    hours = np.tile(np.arange(1, 25), len(days))
+    values = {
+        'DD': rng.choice([0, 90, 180, 270, 990], n),
+        'FH': rng.integers(0, 100, n),
+        'FF': rng.integers(0, 100, n),
+        'FX': rng.integers(0, 150, n),
+        'T': rng.integers(-50, 300, n),
+        'SQ': rng.integers(0, 10, n),
+        'DR': rng.integers(0, 10, n),
+        'RH': rng.integers(-1, 20, n),
+        'P': rng.integers(9900, 10300, n),
+    }
+    lines = ['# BRON: KONINKLIJK NEDERLANDS METEOROLOGISCH INSTITUUT (KNMI)',
+             '#', ','.join(KNMI_COLUMNS), '#']
+    for i in range(n):
+        lines.append(
+            f'  {station},{dates[i]},{hours[i]:>5},{values["DD"][i]:>5},'
+            f'{values["FH"][i]:>5},{values["FF"][i]:>5},{values["FX"][i]:>5},'
+            f'{values["T"][i]:>5},     ,    70,{values["SQ"][i]:>5},'
+            f'    0,{values["DR"][i]:>5},{values["RH"][i]:>5},'
+            f'{values["P"][i]:>5},   70,    8,   87,     ,    5,'
+            f'    0,    0,    0'
+        )
+    return '\n'.join(lines) + '\n'
@@ -1,3 +1,37 @@
-from .bikeride import BikeRide
-from .plot import plot_rides
-from .weather import get_weather
+"""Analyse and plot bicycle rides from gps files
+
+Names are imported from their modules when they are first used, so that
+importing bikeride doesn't load pandas and the other dependencies until they
+are needed (e.g. in worker processes that only use some of them).
+"""
+
+import importlib
+
+
+# module in which each name is defined
+NAMES = {
+    'BikeRide': 'bikeride',
+    'RideCollection': 'collection',
+    'load_rides': 'collection',
+    'Heatmap': 'heatmap',
+    'StatsCollector': 'instrument',
+    'LibraryIndex': 'library',
+    'plot_rides': 'plot',
+    'RideStore': 'store',
+    'WeatherStore': 'weather',
+    'get_weather': 'weather',
+}
+__all__ = list(NAMES)
+
+
+def __getattr__(name):
+    if name not in NAMES:
+        raise AttributeError(f'module {__name__} has no attribute {name}')
+    module = importlib.import_module(f'{__name__}.{NAMES[name]}')
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(NAMES))
@@ -1,15 +1,59 @@
 """Analyse and plot bicycle rides from gps files"""
 
+import copy
+import hashlib
+import json
 import math
-from pathlib import Path, PosixPath
+import os
+import time
+from pathlib import Path, PosixPath, PurePath
 import numpy as np
-import dateutil.parser
 import pandas as pd
-import geopy.distance
-import fitdecode
-from fitdecode.exceptions import FitEOFError, FitHeaderError
-from bs4 import BeautifulSoup as bs
-from ipyleaflet import Map, Polyline
+from bikeride.cache import RideCache
+from bikeride.fit import read_fit
+from bikeride.geo import PointIndex
+from bikeride.gpx import read_gpx
+from bikeride.instrument import StageRecorder
+from bikeride.plot import (
+    MAX_POINTS, get_leaflet, get_runs, pixel_size, simplify_lines
+)
+from bikeride.quality import PAUSE, flag_segments
+from bikeride.segments import build_binned_segments, build_segments, get_bins
+from bikeride.summary import RunningSummary, summarize_groups, summarize_masks
+from bikeride.track import Track
+from bikeride.weather import WeatherStore, index_weather, join_weather
+
+
+# methods that compute each stage of the pipeline
+STAGES = {
+    'columns': 'read_columns',
+    'track': 'get_track',
+    'records': 'get_records',
+    'bins': 'get_bins',
+    'weather': 'read_weather_file',
+    'segment_table': 'records_to_segments',
+    'segments': 'get_segment_dicts',
+    'median_position': 'get_median_position',
+    'summary': 'get_summary',
+    'quality': 'get_quality',
+    'summary_clean': 'get_summary_clean',
+}
+# stages that have to be recomputed if a stage changes
+DEPENDENTS = {
+    'columns': ['track'],
+    'track': ['records', 'bins', 'segment_table', 'median_position'],
+    'bins': ['segment_table'],
+    'weather': ['segment_table'],
+    'segment_table': ['segments', 'summary', 'quality'],
+    'median_position': ['summary', 'summary_clean'],
+    'quality': ['summary_clean'],
+}
+# errors that are added while computing a stage
+STAGE_ERRORS = {
+    'track': ['Start or end point not found'],
+    'segment_table': ['No timestamps recorded'],
+    'summary': ['Duration is zero'],
+}
 
 
 class BikeRide():
@@ -17,10 +61,14 @@ class BikeRide():
     Optionally add data from weather file.
     """
     def __init__(self, path_ride, path_weather=None, limits=None, filetype=None,
-                 additional_vars=None):
+                 additional_vars=None, distance_model='ellipsoidal',
+                 record_fields=None, cache=None, lazy=False, float32=False,
+                 stats=False, hooks=None, resample=None,
+                 resample_by='distance', quality_limits=None):
         """
         :param path_ride: path to gps file
-        :param path_weather: path to csv file containing weather data (see )
+        :param path_weather: path to csv file containing weather data,
+            dataframe with weather data, or WeatherStore
         :param limits: list or tuple containing start location, end location
             and max distance (m) from location, if subset of ride is to be
             extracted. E.g. [(lat, lon), (lat, lon), 100]
@@ -28,21 +76,409 @@ class BikeRide():
             does not correspond to the suffix of the path_ride.
         :param additional_vars: additional variables to be included in ride
             summary.
+        :param distance_model: 'ellipsoidal' (WGS-84, matches geopy within
+            1 mm) or 'haversine' (spherical, faster) for segment lengths.
+        :param record_fields: numeric fields to read from records in .fit
+            files. Defaults to bikeride.fit.RECORD_FIELDS.
+        :param cache: RideCache, or path to directory, to store decoded
+            records (and optionally segments) in.
+        :param lazy: if True, records, weather, segments, median position and
+            summary are computed when they are first accessed.
+        :param float32: store numeric record data other than positions as
+            float32 to save memory.
+        :param stats: if True, record wall time and number of records and
+            segments for each pipeline stage in the stats attribute; if
+            'memory', also record peak memory allocation (which is slow).
+        :param hooks: functions that are called with a dict of stats each
+            time a stage has been computed, e.g. a StatsCollector; passing
+            hooks implies stats=True.
+        :param resample: if set, records are grouped into bins of this size
+            (m, or s if resample_by is 'time') and a segment is created for
+            each bin instead of each pair of records.
+        :param resample_by: 'distance' or 'time'
+        :param quality_limits: dict with limits used to flag pauses and
+            outliers, overriding those in bikeride.quality.LIMITS
         """
+        self._stages = {}
+        self._metadata = {}
         self.path_ride = path_ride
-        self.path_weather = path_weather
-        self.limits = limits
+        self._path_weather = path_weather
+        self._limits = limits
         self.filetype = filetype
         self.additional_vars = additional_vars
+        self.quality_limits = quality_limits
+        self._distance_model = distance_model
+        self._resample = resample
+        self._resample_by = resample_by
+        self.record_fields = record_fields
+        if isinstance(cache, (str, PurePath)):
+            cache = RideCache(cache)
+        self.cache = cache
+        self.cache_key = None
+        self.lazy = lazy
+        self.float32 = float32
         self.errors = set()
-        self.sport = None
-        self.file_type = None
-        self.created_by = None
-        self.records, self.forward, self.limits_found = self.get_records()
-        self.weather = self.read_weather_file()
-        self.segments = self.records_to_segments()
-        self.median_position = self.get_median_position()
-        self.summary = self.get_summary()
+        self.segment_chunks = []
+        self.running = None
+        self.stats = {}
+        self.recorder = None
+        if stats or hooks:
+            self.recorder = StageRecorder(stats == 'memory', hooks)
+        if not lazy:
+            self.compute()
+
+
+    def get_stage(self, stage):
+        """Return result of pipeline stage, computing it if necessary."""
+        if stage not in self._stages:
+            if self.recorder is None:
+                self._stages[stage] = getattr(self, STAGES[stage])()
+            else:
+                self.record_stage(stage)
+        return self._stages[stage]
+
+
+    def record_stage(self, stage):
+        """Compute pipeline stage, store its stats and pass them to hooks."""
+        result, stats = self.recorder.run(getattr(self, STAGES[stage]))
+        self._stages[stage] = result
+        records = None
+        if 'track' in self._stages:
+            records = len(self._stages['track'][0])
+        elif 'columns' in self._stages:
+            records = len(self._stages['columns']['lat'])
+        segments = None
+        if 'segment_table' in self._stages:
+            segments = len(self._stages['segment_table'])
+        stats = {
+            'path': str(self.path_ride),
+            'stage': stage,
+            **stats,
+            'records': records,
+            'segments': segments,
+        }
+        self.stats[stage] = stats
+        self.recorder.notify(stats)
+
+
+    def invalidate(self, stage):
+        """Discard result of pipeline stage and of stages depending on it."""
+        self._stages.pop(stage, None)
+        self.errors.difference_update(STAGE_ERRORS.get(stage, []))
+        if stage == 'segment_table':
+            self.segment_chunks = []
+            self.running = None
+        for dependent in DEPENDENTS.get(stage, []):
+            self.invalidate(dependent)
+
+
+    def compute(self):
+        """Compute all stages that have not been computed yet."""
+        for stage in [
+            'track', 'weather', 'segment_table', 'median_position', 'summary'
+        ]:
+            self.get_stage(stage)
+
+
+    @property
+    def limits(self):
+        """Limits used to extract section of ride"""
+        return self._limits
+
+
+    @limits.setter
+    def limits(self, limits):
+        self._limits = limits
+        self.invalidate('track')
+        # weather from a store depends on the position of the ride
+        if isinstance(self.path_weather, WeatherStore):
+            self.invalidate('weather')
+        if not self.lazy:
+            self.compute()
+
+
+    @property
+    def path_weather(self):
+        """Path to csv file containing weather data, dataframe or
+        WeatherStore"""
+        return self._path_weather
+
+
+    @path_weather.setter
+    def path_weather(self, path_weather):
+        self._path_weather = path_weather
+        self.invalidate('weather')
+        if not self.lazy:
+            self.compute()
+
+
+    @property
+    def distance_model(self):
+        """Distance model used to calculate segment lengths"""
+        return self._distance_model
+
+
+    @distance_model.setter
+    def distance_model(self, distance_model):
+        self._distance_model = distance_model
+        self.invalidate('bins')
+        # the section of the ride within limits is found using distances
+        if self.limits:
+            self.invalidate('track')
+        if not self.lazy:
+            self.compute()
+
+
+    @property
+    def resample(self):
+        """Size of bins records are grouped into (m or s), or None"""
+        return self._resample
+
+
+    @resample.setter
+    def resample(self, resample):
+        self._resample = resample
+        self.invalidate('bins')
+        if not self.lazy:
+            self.compute()
+
+
+    @property
+    def resample_by(self):
+        """Whether records are grouped into bins by 'distance' or 'time'"""
+        return self._resample_by
+
+
+    @resample_by.setter
+    def resample_by(self, resample_by):
+        self._resample_by = resample_by
+        self.invalidate('bins')
+        if not self.lazy:
+            self.compute()
+
+
+    @property
+    def columns(self):
+        """Dict of arrays with data from records in gps file"""
+        return self.get_stage('columns')
+
+
+    @property
+    def track(self):
+        """Track containing arrays of record data"""
+        return self.get_stage('track')[0]
+
+
+    @property
+    def records(self):
+        """List of record dicts (compatibility view of track)"""
+        return self.get_stage('records')
+
+
+    @property
+    def forward(self):
+        """Whether route between limits was ridden from start to end"""
+        return self.get_stage('track')[1]
+
+
+    @property
+    def limits_found(self):
+        """Whether start and end point of limits were found"""
+        return self.get_stage('track')[2]
+
+
+    @property
+    def weather(self):
+        """Weather data indexed by UTC timestamp"""
+        return self.get_stage('weather')
+
+
+    @property
+    def segment_table(self):
+        """Dataframe of segments"""
+        segments = self.get_stage('segment_table')
+        if self.segment_chunks:
+            segments = pd.concat(
+                [segments, *self.segment_chunks], ignore_index=True
+            )
+            self._stages['segment_table'] = segments
+            self.segment_chunks = []
+        return segments
+
+
+    @property
+    def segments(self):
+        """List of segment dicts (compatibility view of segment_table)"""
+        return self.get_stage('segments')
+
+
+    @property
+    def running_summary(self):
+        """Summary stats that are updated in constant time when records are
+        appended (see append)"""
+        return self.get_running().summary
+
+
+    @property
+    def median_position(self):
+        """Median coordinates of records"""
+        return self.get_stage('median_position')
+
+
+    @property
+    def summary(self):
+        """Summary stats and metadata for entire ride"""
+        return self.get_stage('summary')
+
+
+    @property
+    def quality(self):
+        """Series with quality flag of each segment: 0 if fine, otherwise
+        the sum of flags in bikeride.quality.FLAGS"""
+        return pd.Series(
+            self.get_stage('quality'),
+            index=self.segment_table.index,
+            name='quality',
+        )
+
+
+    @property
+    def summary_clean(self):
+        """Summary stats for segments without quality flags"""
+        return self.get_stage('summary_clean')
+
+
+    @property
+    def sport(self):
+        """Activity type"""
+        return self.get_metadata('sport')
+
+
+    @sport.setter
+    def sport(self, sport):
+        self._metadata['sport'] = sport
+
+
+    @property
+    def file_type(self):
+        """Type of .fit file"""
+        return self.get_metadata('file_type')
+
+
+    @file_type.setter
+    def file_type(self, file_type):
+        self._metadata['file_type'] = file_type
+
+
+    @property
+    def created_by(self):
+        """Device used to record activity, or author of .gpx file"""
+        return self.get_metadata('created_by')
+
+
+    @created_by.setter
+    def created_by(self, created_by):
+        self._metadata['created_by'] = created_by
+
+
+    def get_metadata(self, name):
+        """Return metadata from gps file, reading the file if necessary."""
+        self.get_stage('columns')
+        return self._metadata.get(name)
+
+
+    def get_running(self):
+        """Return RunningSummary, creating it from segments if necessary."""
+        if self.running is None:
+            self.running = RunningSummary()
+            self.running.update(self.segment_table)
+        return self.running
+
+
+    def append(self, records):
+        """Add records to the ride, e.g. while it is being recorded.
+
+        Segments are created and joined with weather data for the new records
+        only, and running_summary is updated in constant time per record.
+        Other stages, like summary, are recomputed when accessed.
+        :param records: list of record dicts, dataframe, dict of arrays or
+            Track
+        """
+        if self.limits:
+            raise Exception('Records cannot be appended to a truncated ride')
+        if self.resample:
+            raise Exception('Records cannot be appended to a resampled ride')
+        if not isinstance(records, Track):
+            records = Track(pd.DataFrame(records), self.float32)
+        if not len(records):
+            return
+        # the ride no longer corresponds to the gps file
+        self.cache = None
+        running = self.get_running()
+        offset = max(len(self.track) - 1, 0)
+        self.track.extend(records)
+        tail = self.track[offset:]
+        segments = build_segments(tail, self.distance_model)
+        segments['id'] += offset
+        if len(segments) and (
+            'timestamp' not in tail or np.isnat(tail['timestamp']).any()
+        ):
+            self.errors.add('No timestamps recorded')
+        if self.weather is not None:
+            segments = self.add_weather(segments)
+        self.segment_chunks.append(segments)
+        running.update(segments)
+        # invalidate is not used, as it would also discard segments
+        for stage in [
+            'records', 'segments', 'median_position', 'summary',
+            'summary_clean', 'quality',
+        ]:
+            self._stages.pop(stage, None)
+            self.errors.difference_update(STAGE_ERRORS.get(stage, []))
+
+
+    @classmethod
+    def follow(cls, path_ride, interval=1, timeout=60, **kwargs):
+        """Follow a gps file that is still being written, e.g. by a bicycle
+        computer. Yields the BikeRide object when it is created and each time
+        records have been added to the file; stops if the file hasn't changed
+        for timeout seconds.
+
+        Because .fit and .gpx files can't be decoded from an offset, the file
+        is parsed again after each change; segments, weather data and
+        running_summary are only calculated for the new records.
+        :param path_ride: path to gps file
+        :param interval: seconds between checks of the file size
+        :param timeout: seconds without changes after which to stop
+        :param kwargs: parameters passed on to BikeRide
+        """
+        ride = cls(path_ride, **kwargs)
+        yield ride
+        # errors from parsing an incomplete file are replaced by those of
+        # the next parse
+        stage_errors = {e for errors in STAGE_ERRORS.values() for e in errors}
+        parse_errors = ride.errors - stage_errors
+        size = os.stat(ride.path_ride).st_size
+        last_change = time.monotonic()
+        while time.monotonic() - last_change < timeout:
+            time.sleep(interval)
+            new_size = os.stat(ride.path_ride).st_size
+            if new_size == size:
+                continue
+            size = new_size
+            last_change = time.monotonic()
+            ride.errors -= parse_errors
+            errors = set(ride.errors)
+            track = Track(ride.parse_file(), ride.float32)
+            parse_errors = ride.errors - errors
+            if len(track) > len(ride.track):
+                ride.append(track[len(ride.track):])
+                yield ride
+
+
+    def get_segment_dicts(self):
+        """Convert segment_table to list of dicts."""
+        return self.segment_table.to_dict('records')
 
 
     def to_degree(self, semicircles):
@@ -76,287 +512,245 @@ class BikeRide():
         return twa
 
 
-    def process_fit_frame(self, frame):
-        """Extract data from record from fit file."""
-        record = {
-            field.name: field.value
-            for field
-            in frame
-        }
-        try:
-            position_lat = record['position_lat']
-            if position_lat:
-                record['lat'] = self.to_degree(position_lat)
-            position_long = record['position_long']
-            if position_long:
-                record['lon'] = self.to_degree(position_long)
-        except KeyError:
-            pass
-        return record
-
-
-    def fit_path_to_records(self):
-        """Extract data from .fit file."""
-        with fitdecode.FitReader(self.path_ride) as fit:
-            frames = []
-            try:
-                for frame in fit:
-                    frames.append(frame)
-            except (FitEOFError, FitHeaderError) as e:
-                self.errors.add(str(e))
-        records = [
-            frame for frame
-            in frames
-            if frame.frame_type == fitdecode.FIT_FRAME_DATA
-            and frame.name == 'record'
-        ]
-
-        records = [self.process_fit_frame(record) for record in records]
-        records = [r for r in records if 'lat' in r]
-        if not records:
+    def fit_path_to_columns(self):
+        """Extract columns of records from .fit file."""
+        columns, metadata, errors = read_fit(self.path_ride, self.record_fields)
+        self.errors.update(errors)
+        self.sport = metadata.get('sport')
+        self.file_type = metadata.get('type')
+        self.created_by = metadata.get('garmin_product')
+        if not len(columns['lat']):
             self.errors.add('No records found')
-        other = [
-            frame for frame
-            in frames
-            if frame.frame_type == fitdecode.FIT_FRAME_DATA
-            and frame.name != 'record'
-        ]
-        for frame in other:
-            data = {
-                field.name: field.value
-                for field
-                in frame
+        return columns
+
+
+    def gpx_path_to_columns(self):
+        """Extract columns of records from .gpx file."""
+        columns, metadata, errors = read_gpx(self.path_ride)
+        self.errors.update(errors)
+        if metadata.get('author'):
+            self.created_by = metadata['author']
+        return columns
+
+
+    def parse_file(self):
+        """Extract columns of records from gps file."""
+        if self.filetype == 'fit':
+            return self.fit_path_to_columns()
+        if self.filetype == 'gpx':
+            return self.gpx_path_to_columns()
+        raise Exception(f'Filetype {self.filetype} not implemented')
+
+
+    def read_columns(self):
+        """Extract columns of records from gps file, or from cache."""
+        if not isinstance(self.path_ride, PosixPath):
+            self.path_ride = Path(self.path_ride)
+        if not self.filetype:
+            self.filetype = self.path_ride.suffix
+        self.filetype = self.filetype.lower().replace('.', '')
+        if self.cache:
+            self.cache_key = self.cache.get_key(
+                self.path_ride,
+                filetype=self.filetype,
+                record_fields=self.record_fields,
+            )
+            cached = self.cache.load('records', self.cache_key)
+            if cached:
+                columns, metadata = cached
+                self.sport = metadata['sport']
+                self.file_type = metadata['file_type']
+                self.created_by = metadata['created_by']
+                self.errors.update(metadata['errors'])
+                return columns
+        columns = self.parse_file()
+        if self.cache:
+            metadata = {
+                'sport': self._metadata.get('sport'),
+                'file_type': self._metadata.get('file_type'),
+                'created_by': self._metadata.get('created_by'),
+                'errors': sorted(self.errors),
             }
-            if 'sport' in data:
-                self.sport = data['sport']
-            if 'type' in data:
-                self.file_type = data['type']
-            if 'garmin_product' in data and not self.created_by:
-                self.created_by = data['garmin_product']
-        return records
-
-
-    def trackpoint_to_record(self, trkpt):
-        """Create record from trackpoint."""
-        record = {
-            'lat': float(trkpt.get('lat')),
-            'lon': float(trkpt.get('lon')),
-        }
-        if trkpt.find('time'):
-            record['timestamp'] = dateutil.parser.parse(trkpt.find('time').text)
-        elevation = trkpt.find('ele')
-        if elevation:
-            record['altitude'] = float(elevation.text)
-        temperature = trkpt.find('gpxtpx:atemp')
-        if temperature:
-            record['temperature_recorded'] = float(temperature.text)
-        cadence = trkpt.find('gpxtpx:cad')
-        if cadence:
-            record['cadence'] = float(cadence.text)
-        return record
-
-
-    def gpx_path_to_records(self):
-        """Extract data from .gpx file."""
-        gpxfile = self.path_ride.read_text()
-        soup = bs(gpxfile, 'xml')
-        author = soup.find('author')
-        try:
-            self.created_by = author.find('text').text
-        except AttributeError:
-            pass
-        trackpoints = soup.find_all('trkpt')
-        return [self.trackpoint_to_record(trkpt) for trkpt in trackpoints]
-
-
-    def truncate(self, records):
-        """Try to extract section of route between start and end point."""
-        start, end, threshold = self.limits
-        min_dist_start = math.inf
-        min_dist_end = math.inf
-        limit_idx = [None, None]
-        for i, record in enumerate(records):
-            current = [record['lat'], record['lon']]
-            dist_start = geopy.distance.distance(current, start).m
-            if dist_start < min_dist_start:
-                limit_idx[0] = i
-                min_dist_start = dist_start
-            dist_end = geopy.distance.distance(current, end).m
-            if dist_end < min_dist_end:
-                limit_idx[1] = i
-                min_dist_end = dist_end
-        limits_found = (
-            (min_dist_start < threshold) &
-            (min_dist_end < threshold)
-        )
+            self.cache.save('records', self.cache_key, columns, metadata)
+        return columns
+
+
+    def find_limits(self, index, limits):
+        """Find indices of records nearest to start and end point of limits.
+
+        Return start index, end index and whether both points were found
+        within the threshold distance.
+        """
+        start, end, threshold = limits
+        idx_start, _ = index.nearest(start[0], start[1], threshold)
+        idx_end, _ = index.nearest(end[0], end[1], threshold)
+        limits_found = idx_start is not None and idx_end is not None
+        return idx_start, idx_end, limits_found
+
+
+    def truncate(self, track, limits=None):
+        """Try to extract section of route between start and end point.
+
+        :param track: Track containing records
+        :param limits: limits to use instead of self.limits
+        """
+        if limits is None:
+            limits = self.limits
+        index = PointIndex(track['lat'], track['lon'], self.distance_model)
+        idx_start, idx_end, limits_found = self.find_limits(index, limits)
         if limits_found:
-            forward = limit_idx[1] > limit_idx[0]
+            forward = idx_end > idx_start
             if forward:
-                records = records[limit_idx[0]: limit_idx[1]]
+                track = track[idx_start: idx_end]
             else:
-                records = records[limit_idx[1]: limit_idx[0]]
+                track = track[idx_end: idx_start]
         else:
             forward = None
-        return records, limits_found, forward
+        return track, limits_found, forward
+
+
+    def sections(self, sections):
+        """Extract multiple sections from the ride, without parsing the gps
+        file again.
+
+        Returns a list with a BikeRide object for each section, or None if
+        the start or end point of the section was not found.
+        :param sections: list of limits, e.g.
+            [[(lat, lon), (lat, lon), 100], [(lat, lon), (lat, lon), 50]]
+        """
+        index = PointIndex(self.track['lat'], self.track['lon'], self.distance_model)
+        rides = []
+        for limits in sections:
+            idx_start, idx_end, limits_found = self.find_limits(index, limits)
+            if not limits_found:
+                rides.append(None)
+                continue
+            forward = idx_end > idx_start
+            ride = copy.copy(self)
+            # records of a section may differ from those of a ride created
+            # with the same limits, so segments are not cached
+            ride.cache = None
+            ride._limits = limits
+            ride.errors = set(self.errors)
+            ride.stats = {}
+            ride.segment_chunks = []
+            ride.running = None
+            ride._stages = {
+                stage: self._stages[stage]
+                for stage in ['columns', 'weather']
+                if stage in self._stages
+            }
+            track = self.track[min(idx_start, idx_end): max(idx_start, idx_end)]
+            ride._stages['track'] = (track, forward, limits_found)
+            if not ride.lazy:
+                ride.compute()
+            rides.append(ride)
+        return rides
 
 
     def get_records(self):
-        """Extract records from gps file."""
-        if not isinstance(self.path_ride, PosixPath):
-            self.path_ride = Path(self.path_ride)
-        path_ride = self.path_ride
-        if not self.filetype:
-            self.filetype = path_ride.suffix
-        self.filetype = self.filetype.lower().replace('.', '')
-        if self.filetype == 'fit':
-            records = self.fit_path_to_records()
-        elif self.filetype == 'gpx':
-            records = self.gpx_path_to_records()
-        else:
-            raise Exception(f'Filetype {self.filetype} not implemented')
+        """Convert track to list of dicts."""
+        return self.track.to_records()
+
+
+    def get_track(self):
+        """Create track from gps file data and truncate it if limits are
+        set."""
+        track = Track(self.columns, self.float32)
         limits_found = None
         forward = None
         if self.limits:
-            records, limits_found, forward = self.truncate(records)
+            track, limits_found, forward = self.truncate(track)
             if not limits_found:
                 self.errors.add('Start or end point not found')
-        return records, forward, limits_found
+        return track, forward, limits_found
+
+
+    def get_bins(self):
+        """Return indices of records at the boundaries of bins and length of
+        track within each bin, or None if the ride is not resampled."""
+        if not self.resample:
+            return None
+        return get_bins(
+            self.track, self.resample, self.resample_by, self.distance_model
+        )
 
 
     def get_median_position(self):
         """Calculate median coordinates for ride."""
-        median_lat = np.median([rec['lat'] for rec in self.records])
-        median_lon = np.median([rec['lon'] for rec in self.records])
+        median_lat = np.median(self.track['lat'])
+        median_lon = np.median(self.track['lon'])
         return (median_lat, median_lon)
 
 
     def read_weather_file(self):
-        """Read data from csv containing weather data."""
-        if not self.path_weather:
+        """Read data from csv containing weather data, or get it from
+        dataframe or weather store, and index it by UTC timestamp."""
+        weather = self.path_weather
+        if weather is None or isinstance(weather, str) and not weather:
             return None
-        weather = pd.read_csv(self.path_weather)
-        dt_vars = [
-            var for var in ['date', 'hour', 'minute']
-            if var in list(weather.columns)
-        ]
-        weather = weather.sort_values(by=dt_vars)
-        return weather
-
-
-    def add_weather(self, segment):
-        """Add weather data to segment."""
-        weather = self.weather
-        timestamp = segment['timestamp_start']
-
-        date = int(timestamp.strftime('%Y%m%d'))
-        hour = int(timestamp.strftime('%H'))
-        minute = int(timestamp.strftime('%S'))
-        if 'minute' in weather.columns:
-            subset_weather = weather[
-                (weather.date == date) &
-                (weather.hour == hour) &
-                (weather.minute == minute)
-            ]
-        elif 'hour' in weather.columns:
-            t1 = timestamp + pd.Timedelta(hours=1)
-            h1 = int(t1.strftime('%H'))
-            subset_weather = weather[
-                (weather.date == date) &
-                (weather.hour.isin([hour, h1]))
-            ]
-        else:
-            subset_weather = weather[
-                (weather.date == date)
-            ]
-        if subset_weather.empty:
-            return segment
-        if 'hour' in weather.columns and 'minute' not in weather.columns:
-            for col in weather.columns:
-                if col.startswith('Unnamed'):
-                    continue
-                values = list(subset_weather[col])
-                try:
-                    value = (60 - minute) * values[0] + minute * values[-1]
-                    value /= 60
-                except TypeError:
-                    value = values[0]
-                segment[col] = value
-        else:
-            for _, row in subset_weather.iterrows():
-                for col in weather.columns:
-                    segment[col] = row[col]
-                break
-        if 'wind_direction' in segment:
-            wind_direction = segment['wind_direction']
-            heading = segment['heading']
-            twa = self.get_twa(heading, wind_direction)
-            segment['twa'] = twa
-            segment['twa_rounded_abs'] = abs(10 * round(segment['twa'] / 10))
-            if 'wind_speed' in segment:
-                headwind = segment['wind_speed'] * math.cos(math.radians(twa))
-                segment['headwind'] = headwind
-        return segment
+        if isinstance(weather, WeatherStore):
+            return weather.get_ride_weather(self)
+        if not isinstance(weather, pd.DataFrame):
+            weather = pd.read_csv(weather)
+        return index_weather(weather)
+
+
+    def add_weather(self, segments):
+        """Add weather data to dataframe of segments."""
+        return join_weather(segments, self.weather)
 
 
     def records_to_segments(self):
-        """Create segments from pairs of records."""
-        segments = []
-        records = self.records
-        for i in range(len(records) - 1):
-            start = records[i]
-            end = records[i + 1]
-            pos_start = (start['lat'], start['lon'])
-            pos_end = (end['lat'], end['lon'])
-            length_calculated = geopy.distance.distance(pos_start, pos_end).m
-
-            segment = {
-                'id': i,
-                'lat_start': start['lat'],
-                'lon_start': start['lon'],
-                'lat_end': end['lat'],
-                'lon_end': end['lon'],
-                'length_calculated': length_calculated,
-                'heading': self.get_bearing(pos_start, pos_end),
-            }
-            try:
-                timestamp_start = start['timestamp']
-                timestamp_end = end['timestamp']
-                segment['timestamp_start'] = timestamp_start
-                segment['timestamp_end'] = timestamp_end
-                duration = timestamp_end - timestamp_start
-                try:
-                    duration = duration.seconds
-                except AttributeError:
-                    pass
-                segment['duration'] = duration
-            except KeyError:
-                self.errors.add('No timestamps recorded')
-
-            if 'distance' in start and 'distance' in end:
-                segment['distance_recorded_start'] = start['distance']
-                segment['distance_recorded_end'] = end['distance']
-                segment['length_recorded'] = end['distance'] - start['distance']
-            if 'temperature' in start:
-                segment['temp_recorded_start'] = start['temperature']
-            if 'speed' in start:
-                segment['speed_recorded_start'] = start['speed']
-            if 'speed' in end:
-                segment['speed_recorded_end'] = end['speed']
-            if 'altitude' in start:
-                segment['altitude_start'] = start['altitude']
-            if 'altitude' in end:
-                segment['altitude_end'] = end['altitude']
-            if 'altitude' in start and 'altitude' in end:
-                segment['ascent'] = end['altitude'] - start['altitude']
-                if segment['length_calculated'] > 0:
-                    segment['gradient'] = 100 * segment['ascent']
-                    segment['gradient'] /= segment['length_calculated']
-            if self.path_weather:
-                segment = self.add_weather(segment)
-            segments.append(segment)
+        """Create dataframe of segments from pairs of records."""
+        if self.cache and self.cache.segments:
+            key = self.get_segments_cache_key()
+            cached = self.cache.load('segments', key)
+            if cached:
+                columns, metadata = cached
+                self.errors.update(metadata['errors'])
+                return pd.DataFrame(columns)
+        track = self.track
+        bins = self.get_stage('bins')
+        if bins is None:
+            segments = build_segments(track, self.distance_model)
+        else:
+            segments = build_binned_segments(
+                track, *bins, self.distance_model
+            )
+        if len(segments) and (
+            'timestamp' not in track or np.isnat(track['timestamp']).any()
+        ):
+            self.errors.add('No timestamps recorded')
+        if self.weather is not None:
+            segments = self.add_weather(segments)
+        if self.cache and self.cache.segments:
+            metadata = {'errors': sorted(self.errors)}
+            self.cache.save('segments', key, dict(segments.items()), metadata)
         return segments
 
 
+    def get_segments_cache_key(self):
+        """Return cache key for segments, which depend on the records and on
+        the options used to create segments and add weather data."""
+        weather_file = None
+        if isinstance(self.path_weather, (str, PurePath)):
+            stat = os.stat(self.path_weather)
+            weather_file = [str(self.path_weather), stat.st_mtime_ns, stat.st_size]
+        elif self.weather is not None:
+            weather_file = int(pd.util.hash_pandas_object(self.weather).sum())
+        options = {
+            'records': self.cache_key,
+            'limits': self.limits,
+            'distance_model': self.distance_model,
+            'weather_file': weather_file,
+        }
+        if self.resample:
+            options['resample'] = [self.resample, self.resample_by]
+        options = json.dumps(options, sort_keys=True, default=str)
+        return hashlib.sha1(options.encode()).hexdigest()
+
+
     def get_summary(self, mask=None):
         """Return dict with summary stats and metadata.
 
@@ -364,74 +758,50 @@ class BikeRide():
         :params mask: list of booleans to determine which segments to use for
             calculating stats
         """
-        segments = self.segments
+        segments = self.segment_table
         summary = {'filename': self.path_ride.name}
-        if segments:
-            if mask:
-                segments = [sgm for i, sgm in enumerate(segments) if mask[i]]
-            length_calculated = sum(sgm['length_calculated'] for sgm in segments)
+        if mask is not None and len(mask):
+            segments = segments[np.asarray(mask, dtype=bool)]
+        if len(segments):
+            length_calculated = segments.length_calculated.sum()
             summary['length_calculated'] = length_calculated
-            try:
-                duration = sum(sgm['duration'] for sgm in segments)
+            duration = None
+            if 'duration' in segments:
+                duration = segments.duration.sum()
                 summary['duration'] = duration
-                try:
+                if duration:
                     summary['speed_from_length_calculated'] = length_calculated / duration
-                except ZeroDivisionError:
+                else:
                     self.errors.add('Duration is zero')
-            except KeyError:
-                pass
 
-            first_sgm = segments[0]
-            last_sgm = segments[-1]
+            first_sgm = segments.iloc[0]
+            last_sgm = segments.iloc[-1]
             summary['lat_start'] = first_sgm['lat_start']
             summary['lon_start'] = first_sgm['lon_start']
             summary['direction'] = self.get_bearing(
                 (first_sgm['lat_start'], first_sgm['lon_start']), self.median_position
             )
 
-            try:
+            if 'timestamp_start' in segments:
                 summary['timestamp_start'] = first_sgm['timestamp_start']
                 summary['timestamp_end'] = last_sgm['timestamp_end']
-            except KeyError:
-                pass
 
-            try:
-                length_recorded = sum(sgm['length_recorded'] for sgm in segments)
+            if 'length_recorded' in segments:
+                length_recorded = segments.length_recorded.sum()
                 summary['length_recorded'] = length_recorded
-                summary['speed_from_length_recorded'] = length_recorded / duration
-            except KeyError:
-                pass
-
-            try:
-                summary['temperature'] = sum(
-                    sgm['temperature'] * sgm['duration'] for sgm in segments
-                ) / duration
-            except KeyError:
-                pass
-            try:
-                summary['wind_speed'] = sum(
-                    sgm['wind_speed'] * sgm['duration'] for sgm in segments
-                ) / duration
-            except KeyError:
-                pass
-            try:
-                summary['wind_direction'] = sum(
-                    sgm['wind_direction'] * sgm['duration'] for sgm in segments
-                ) / duration
-            except KeyError:
-                pass
-            try:
-                summary['total_ascent'] = sum(
-                    sgm['ascent'] for sgm in segments if sgm['ascent'] > 0
-                )
-            except KeyError:
-                pass
-            try:
-                summary['total_descent'] = sum(
-                    sgm['ascent'] for sgm in segments if sgm['ascent'] < 0
-                )
-            except KeyError:
-                pass
+                if duration:
+                    summary['speed_from_length_recorded'] = length_recorded / duration
+
+            if duration:
+                for var in ['temperature', 'wind_speed', 'wind_direction']:
+                    if var in segments:
+                        summary[var] = (
+                            segments[var] * segments.duration
+                        ).sum() / duration
+            if 'ascent' in segments:
+                ascent = segments.ascent
+                summary['total_ascent'] = ascent[ascent > 0].sum()
+                summary['total_descent'] = ascent[ascent < 0].sum()
 
         if self.sport:
             summary['sport'] = self.sport
@@ -444,71 +814,125 @@ class BikeRide():
             summary['file_type'] = self.file_type
         if self.created_by:
             summary['created_by'] = self.created_by
-        if self.additional_vars:
+        if self.additional_vars and len(segments):
             for var in self.additional_vars:
-                if var not in self.segments[0]:
+                if var not in segments:
                     continue
-                numeric_values = [
-                    sgm[var] * sgm['duration']
-                    for sgm in segments
-                    if isinstance(sgm[var], (int, float))
-                ]
-                if numeric_values:
-                    value = sum(numeric_values) / duration
+                values = segments[var]
+                if pd.api.types.is_numeric_dtype(values) and duration:
+                    value = (values * segments.duration).sum() / duration
                 else:
-                    value = segments[0][var]
+                    value = values.iloc[0]
                 summary[var] = value
 
         return summary
 
 
-    def plot(self, mask=None, segment_ids=None, zoom=12):
+    def get_quality(self):
+        """Return array with quality flags of segments."""
+        return flag_segments(self.segment_table, self.quality_limits)
+
+
+    def get_summary_clean(self):
+        """Return dict with summary stats for segments without quality
+        flags, with the number of flagged segments and the duration of
+        pauses."""
+        flags = self.get_stage('quality')
+        summary = self.get_summary(mask=flags == 0)
+        summary['segments_flagged'] = int(np.count_nonzero(flags))
+        if 'duration' in self.segment_table:
+            summary['pause_duration'] = self.segment_table.duration[
+                (flags & PAUSE) > 0
+            ].sum()
+        return summary
+
+
+    def summarize_by(self, by, bins=None):
+        """Return dataframe with summary stats for groups of segments,
+        calculated with grouped reductions.
+
+        :param by: column name, list of column names, or array with a group
+            key for each segment, e.g. 'twa_rounded_abs'
+        :param bins: if by is a column name: bins to group its values in, as
+            accepted by pd.cut, e.g. [-20, -5, -2, 2, 5, 20] for gradient
+        """
+        segments = self.segment_table
+        if bins is not None:
+            by = pd.cut(segments[by], bins)
+        return summarize_groups(
+            segments, by, self.median_position, self.additional_vars
+        )
+
+
+    def summarize_masks(self, masks, names=None):
+        """Return dataframe with summary stats for each of a number of
+        (possibly overlapping) subsets of segments.
+
+        :param masks: 2-D array or list of lists of booleans, with a row for
+            each subset and a column for each segment
+        :param names: names of subsets, used as index
+        """
+        return summarize_masks(
+            self.segment_table, masks, names, self.median_position,
+            self.additional_vars
+        )
+
+
+    def plot(self, mask=None, segment_ids=None, zoom=12,
+             max_points=MAX_POINTS, tolerance=None):
         """Plot ride segments on map in Jupyter Notebook
 
+        Consecutive selected segments are merged into one line, and lines
+        are simplified before they are plotted.
         :params mask: list of booleans to select which segments of the ride
             to map
         :params segment_ids: index or list of segment ids to select which
             segments of the ride to map
         :params zoom: initial zoom level
+        :params max_points: maximum number of points to plot
+        :params tolerance: tolerance (m) for simplifying lines; defaults to
+            the size of a pixel two zoom levels deeper than the initial zoom
+            level
         """
-        if mask and segment_ids:
+        leaflet = get_leaflet()
+        has_mask = mask is not None and len(mask) > 0
+        if segment_ids is not None and np.isscalar(segment_ids):
+            segment_ids = [segment_ids]
+        has_ids = segment_ids is not None and len(segment_ids) > 0
+        if has_mask and has_ids:
             raise Exception('Pass either a mask or a list of ids, not both')
-        segments = self.segments
-        if mask:
-            segments = [sgm for i, sgm in enumerate(segments) if mask[i]]
-        elif segment_ids:
-            if not isinstance(segment_ids, list):
-                segment_ids = [segment_ids]
-            segments = [sgm for sgm in segments if sgm['id'] in segment_ids]
-        lats_start = [sgm['lat_start'] for sgm in segments]
-        lons_start = [sgm['lon_start'] for sgm in segments]
-        lats_end = [sgm['lat_end'] for sgm in segments]
-        lons_end = [sgm['lon_end'] for sgm in segments]
-        median_lat = np.median(lats_start + lats_end)
-        median_lon = np.median(lons_start + lons_end)
-        map = Map(center=(median_lat, median_lon), zoom=zoom)
-        if mask or segment_ids:
-            for sgm in segments:
-                position_start = (sgm['lat_start'], sgm['lon_start'])
-                position_end = (sgm['lat_end'], sgm['lon_end'])
-                poly_line = Polyline(
-                    locations=(position_start, position_end),
-                    color="red",
-                    fill=False,
-                    weight=3
-                )
-                map.add_layer(poly_line)
+        segments = self.segment_table
+        if has_mask:
+            selected = np.asarray(mask, dtype=bool)
+        elif has_ids:
+            selected = np.isin(segments['id'], list(segment_ids))
         else:
-            positions = [
-                (sgm['lat_start'], sgm['lon_start'])
-                for sgm in segments
-            ]
-            positions.append((segments[-1]['lat_end'], segments[-1]['lon_end']))
-            poly_line = Polyline(
-                locations=positions,
-                color="red",
-                fill=False,
-                weight=3
+            selected = np.ones(len(segments), dtype=bool)
+        lats_start = segments['lat_start'].to_numpy()
+        lons_start = segments['lon_start'].to_numpy()
+        lats_end = segments['lat_end'].to_numpy()
+        lons_end = segments['lon_end'].to_numpy()
+        median_lat = np.median(np.concatenate(
+            [lats_start[selected], lats_end[selected]]
+        ))
+        median_lon = np.median(np.concatenate(
+            [lons_start[selected], lons_end[selected]]
+        ))
+        map = leaflet.Map(center=(median_lat, median_lon), zoom=zoom)
+        lines = [
+            (
+                np.append(lats_start[start:end], lats_end[end - 1]),
+                np.append(lons_start[start:end], lons_end[end - 1]),
             )
-            map.add_layer(poly_line)
+            for start, end in get_runs(selected)
+        ]
+        if tolerance is None:
+            tolerance = pixel_size(zoom + 2, median_lat)
+        poly_line = leaflet.Polyline(
+            locations=simplify_lines(lines, tolerance, max_points),
+            color="red",
+            fill=False,
+            weight=3
+        )
+        map.add_layer(poly_line)
         return map
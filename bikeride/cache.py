@@ -0,0 +1,180 @@
+"""Cache decoded records and segments of gps files on disk"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import zipfile
+import numpy as np
+import pandas as pd
+
+
+# increase if changes to the parsers or segment builder change their output
+PARSER_VERSION = 1
+# when the cache exceeds max_size, entries are removed until it is below
+# this fraction of max_size, so the directory isn't scanned on every save
+EVICT_FRACTION = 0.9
+
+
+def file_digest(path):
+    """Return sha1 hash object of contents of file"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest
+
+
+def save_columns(path, columns, metadata):
+    """Save dict of columns and metadata to .npz file.
+
+    Datetime columns are stored as int64 (UTC, in their own unit) and object
+    columns as strings, with a mask for missing values.
+    """
+    arrays = {}
+    datetimes = {}
+    objects = []
+    for i, (name, values) in enumerate(columns.items()):
+        values = pd.Series(values)
+        if isinstance(values.dtype, pd.DatetimeTZDtype) or (
+            pd.api.types.is_datetime64_dtype(values)
+        ):
+            values = pd.to_datetime(values, utc=True)
+            arrays[f'col{i}'] = values.array.asi8
+            datetimes[name] = values.array.unit
+        elif pd.api.types.is_numeric_dtype(values):
+            arrays[f'col{i}'] = values.to_numpy()
+        else:
+            missing = values.isna().to_numpy()
+            arrays[f'col{i}'] = values.astype(str).to_numpy(str)
+            arrays[f'missing{i}'] = missing
+            objects.append(name)
+    metadata = {
+        **metadata,
+        'columns': list(columns),
+        'datetimes': datetimes,
+        'objects': objects,
+    }
+    arrays['metadata'] = np.array(json.dumps(metadata, default=str))
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_columns(path):
+    """Load dict of columns and metadata from .npz file"""
+    with np.load(path, allow_pickle=False) as data:
+        metadata = json.loads(str(data['metadata']))
+        columns = {}
+        for i, name in enumerate(metadata['columns']):
+            values = data[f'col{i}']
+            if name in metadata['datetimes']:
+                unit = metadata['datetimes'][name]
+                values = pd.to_datetime(values, unit=unit, utc=True)
+            elif name in metadata['objects']:
+                values = values.astype(object)
+                values[data[f'missing{i}']] = None
+            columns[name] = values
+    for key in ['columns', 'datetimes', 'objects']:
+        del metadata[key]
+    return columns, metadata
+
+
+class RideCache():
+    """Store decoded records, and optionally segments, of gps files in a
+    directory. Entries are keyed by the contents and modification time of the
+    gps file, the parser version and the options used. If the total size of
+    the directory exceeds max_size, the least recently used entries are
+    removed. The total size is kept up to date when entries are saved, and
+    the directory is only scanned when it exceeds max_size (entries saved by
+    other processes are counted then).
+    """
+    def __init__(self, directory, max_size=None, segments=False):
+        """
+        :param directory: directory to store cache files in
+        :param max_size: maximum total size of cache files (bytes)
+        :param segments: also cache segments (incl. weather data)
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.segments = segments
+        # total size of cache files (bytes), or None if not known yet
+        self.size = None
+
+
+    def get_key(self, path, **options):
+        """Return key for file, based on its contents and modification time,
+        the parser version and options."""
+        digest = file_digest(path)
+        options = {
+            'mtime': os.stat(path).st_mtime_ns,
+            'parser_version': PARSER_VERSION,
+            **options,
+        }
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+
+    def get_path(self, kind, key):
+        """Return path of cache file"""
+        return self.directory / f'{kind}-{key}.npz'
+
+
+    def load(self, kind, key):
+        """Return columns and metadata from cache, or None if not cached"""
+        path = self.get_path(kind, key)
+        try:
+            columns, metadata = load_columns(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+        # mark entry as recently used
+        os.utime(path)
+        return columns, metadata
+
+
+    def save(self, kind, key, columns, metadata):
+        """Store columns and metadata in cache"""
+        path = self.get_path(kind, key)
+        if self.max_size and self.size is not None:
+            try:
+                self.size -= path.stat().st_size
+            except OSError:
+                pass
+        save_columns(path, columns, metadata)
+        if not self.max_size:
+            return
+        if self.size is not None:
+            self.size += path.stat().st_size
+        if self.size is None or self.size > self.max_size:
+            self.evict()
+
+
+    def evict(self):
+        """Remove least recently used entries if cache exceeds max_size,
+        until it is below EVICT_FRACTION of max_size."""
+        if not self.max_size:
+            return
+        entries = []
+        for path in self.directory.glob('*.npz'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_size:
+            for _, size, path in sorted(entries, key=lambda e: e[0]):
+                if total <= self.max_size * EVICT_FRACTION:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+        self.size = total
+
+
+    def clear(self):
+        """Remove all entries"""
+        for path in self.directory.glob('*.npz'):
+            path.unlink(missing_ok=True)
+        self.size = 0
@@ -0,0 +1,202 @@
+"""Process a library of gps files in parallel"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+from pathlib import Path
+import pandas as pd
+from bikeride.bikeride import BikeRide
+from bikeride.weather import WeatherStore
+
+
+def get_error(path, e):
+    """Return dict with path of file and error that occurred processing it"""
+    return {'path': str(path), 'error': f'{type(e).__name__}: {e}'}
+
+
+def process_ride(path, keep_segments=False, **kwargs):
+    """Create BikeRide from gps file and return a dict with its summary and
+    errors, and optionally its segments dataframe.
+
+    Runs in worker processes; only the summary dict, the errors, the stats
+    of pipeline stages (if recorded) and the columnar segments dataframe are
+    sent back, not the ride's records or segment dicts. Exceptions are caught
+    and returned as error, so that one corrupt file doesn't stop the
+    processing of a library.
+    """
+    try:
+        ride = BikeRide(path, **kwargs)
+        result = {
+            'path': str(path),
+            'summary': ride.summary,
+            'errors': sorted(ride.errors),
+        }
+        if keep_segments:
+            result['segments'] = ride.segment_table
+    except Exception as e:
+        return get_error(path, e)
+    if ride.stats:
+        result['stats'] = list(ride.stats.values())
+    return result
+
+
+def get_position(path, path_weather, **kwargs):
+    """Parse gps file and return the position of the ride that weather store
+    path_weather uses to find its location, or None if it can't be
+    processed.
+
+    Runs in worker processes.
+    """
+    try:
+        ride = BikeRide(path, **{**kwargs, 'lazy': True, 'stats': False})
+        return path_weather.get_position(ride)
+    except Exception:
+        return None
+
+
+def with_weather(func, path, path_weather, **kwargs):
+    """Call func with path and weather, e.g. to map func over both"""
+    return func(path, path_weather=path_weather, **kwargs)
+
+
+def map_paths(func, paths, workers=None, chunksize=None, **kwargs):
+    """Return iterator of func(path, **kwargs) for each path, in order,
+    computed on a pool of worker processes.
+
+    If path_weather is a WeatherStore, the positions of the rides are found
+    on the pool first and their weather data are downloaded in this process,
+    so each location and date is downloaded once; each call of func gets a
+    store with only the data for its ride.
+    :param func: function to call, defined at module level (use partial to
+        pass other parameters than those of BikeRide)
+    :param paths: paths to gps files
+    :param workers: number of worker processes (defaults to number of
+        cpus); if 1, files are processed in the current process
+    :param chunksize: number of files sent to a worker at once (defaults to
+        spreading the files over four chunks per worker)
+    :param kwargs: parameters of BikeRide, passed on to func
+    """
+    paths = list(paths)
+    workers = workers or os.cpu_count() or 1
+    chunksize = chunksize or max(1, len(paths) // (4 * workers))
+    if workers == 1 or len(paths) < 2:
+        yield from map(partial(func, **kwargs), paths)
+        return
+    store = kwargs.get('path_weather')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if not isinstance(store, WeatherStore):
+            yield from executor.map(
+                partial(func, **kwargs), paths, chunksize=chunksize
+            )
+            return
+        kwargs.pop('path_weather')
+        positions = list(executor.map(
+            partial(get_position, path_weather=store.split([None])[0],
+                    **kwargs),
+            paths, chunksize=chunksize,
+        ))
+        store.fetch(store.plan([
+            position for position in positions if position
+        ]))
+        yield from executor.map(
+            partial(with_weather, func, **kwargs),
+            paths, store.split(positions), chunksize=chunksize,
+        )
+
+
+class RideCollection():
+    """Process gps files on a process pool and store summaries, errors and
+    (optionally) segments.
+    """
+    def __init__(self, paths, workers=None, chunksize=None,
+                 keep_segments=False, **kwargs):
+        """
+        :param paths: paths to gps files
+        :param workers: number of worker processes (defaults to number of
+            cpus); if 1, files are processed in the current process
+        :param chunksize: number of files sent to a worker at once (defaults
+            to spreading the files over four chunks per worker)
+        :param keep_segments: store a segments dataframe for each file
+        :param kwargs: parameters passed on to BikeRide, e.g. path_weather
+            or limits. If hooks are passed, they are called in this process
+            with the stats of each stage after all files have been processed.
+            If path_weather is a WeatherStore, its data are downloaded in
+            this process before the files are processed (see map_paths).
+        """
+        self.paths = [Path(path) for path in paths]
+        self.workers = workers or os.cpu_count() or 1
+        self.chunksize = chunksize or max(
+            1, len(self.paths) // (4 * self.workers)
+        )
+        self.keep_segments = keep_segments
+        # hooks can't be called in worker processes, as changes to them
+        # would be lost
+        self.hooks = kwargs.pop('hooks', None) or []
+        if self.hooks and not kwargs.get('stats'):
+            kwargs['stats'] = True
+        self.kwargs = kwargs
+        self.results = self.process()
+        self.summaries = self.get_summaries()
+        self.failures = self.get_failures()
+        self.stats = self.get_stats()
+        self.segments = {
+            result['path']: result['segments']
+            for result in self.results
+            if 'segments' in result
+        }
+
+
+    def process(self):
+        """Process gps files and return list of results, in order of paths"""
+        func = partial(process_ride, keep_segments=self.keep_segments)
+        return list(map_paths(
+            func, self.paths, self.workers, self.chunksize, **self.kwargs
+        ))
+
+
+    def get_summaries(self):
+        """Return dataframe with summaries of rides that could be processed"""
+        return pd.DataFrame([
+            result['summary']
+            for result in self.results
+            if 'summary' in result
+        ])
+
+
+    def get_stats(self):
+        """Call hooks with stats of the stages of each ride, and return
+        dataframe with a row for each stage of each ride."""
+        rows = [
+            stats
+            for result in self.results
+            for stats in result.get('stats', [])
+        ]
+        for stats in rows:
+            for hook in self.hooks:
+                hook(stats)
+        return pd.DataFrame(rows)
+
+
+    def get_failures(self):
+        """Return dataframe with path and error for each file that could not
+        be processed."""
+        return pd.DataFrame(
+            [
+                {'path': result['path'], 'error': result['error']}
+                for result in self.results
+                if 'error' in result
+            ],
+            columns=['path', 'error'],
+        )
+
+
+def load_rides(paths, workers=None, **kwargs):
+    """Process gps files in parallel and return a dataframe with ride
+    summaries and a dataframe with files that could not be processed.
+
+    :param paths: paths to gps files
+    :param workers: number of worker processes (defaults to number of cpus)
+    :param kwargs: parameters passed on to RideCollection and BikeRide
+    """
+    collection = RideCollection(paths, workers=workers, **kwargs)
+    return collection.summaries, collection.failures
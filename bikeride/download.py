@@ -0,0 +1,36 @@
+"""Shared helpers to download data over http"""
+
+
+# http status codes after which a request is retried
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+def get_session(retries=3, backoff_factor=0.5, pool_size=10):
+    """Return requests session that reuses connections and retries failed
+    requests with exponential backoff.
+
+    :param retries: maximum number of retries per request
+    :param backoff_factor: backoff factor (s); the n-th retry waits about
+        backoff_factor * 2 ** (n - 1) seconds
+    :param pool_size: maximum number of connections kept open per host,
+        should be at least the number of concurrent requests
+    """
+    # imported here, as requests takes a while to import and is only needed
+    # to download weather data
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
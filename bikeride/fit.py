@@ -0,0 +1,116 @@
+"""Read records and metadata from .fit files in a single pass"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+FIT_UTC_REFERENCE = 631065600  # 1989-12-31 00:00 UTC as unix timestamp
+RECORD_FIELDS = [
+    'timestamp',
+    'distance',
+    'altitude',
+    'speed',
+    'cadence',
+    'temperature',
+    'heart_rate',
+]
+METADATA_FIELDS = ['sport', 'type', 'garmin_product']
+INITIAL_CAPACITY = 1024
+
+
+def to_degree(semicircles):
+    """Convert semicircles to degrees"""
+    return semicircles * (180 / (2**31))
+
+
+def iter_fit(path, fields, metadata, errors):
+    """Yield a tuple of values for each record message in .fit file.
+
+    Each tuple contains position_lat, position_long (semicircles) and the
+    values of fields, with None for missing values. Timestamps are returned
+    as unix timestamps. Values of METADATA_FIELDS in other messages are
+    stored in metadata; errors are added to errors.
+    """
+    # imported here, so that processing .gpx files doesn't load fitdecode
+    import fitdecode
+    from fitdecode.exceptions import FitEOFError, FitHeaderError
+    positions = {name: i for i, name in enumerate(fields, start=2)}
+    positions['position_lat'] = 0
+    positions['position_long'] = 1
+    with fitdecode.FitReader(path) as fit:
+        try:
+            for frame in fit:
+                if frame.frame_type != fitdecode.FIT_FRAME_DATA:
+                    continue
+                if frame.name != 'record':
+                    for field in frame.fields:
+                        name = field.name
+                        if name not in METADATA_FIELDS:
+                            continue
+                        if name == 'garmin_product' and name in metadata:
+                            continue
+                        metadata[name] = field.value
+                    continue
+                values = [None] * len(positions)
+                for field in frame.fields:
+                    i = positions.get(field.name)
+                    if i is None:
+                        continue
+                    if field.name == 'timestamp':
+                        if field.raw_value is not None:
+                            values[i] = field.raw_value + FIT_UTC_REFERENCE
+                    else:
+                        values[i] = field.value
+                yield values
+        except (FitEOFError, FitHeaderError) as e:
+            errors.add(str(e))
+
+
+def read_fit(path, fields=None):
+    """Read records and metadata from .fit file.
+
+    Returns a dict of arrays with lat, lon and the requested record fields,
+    a dict with metadata (sport, type, garmin_product) and a set of errors.
+    Only records with a position are included; fields that are not found
+    in any record are left out.
+    :param path: path to .fit file
+    :param fields: numeric record fields to read (default RECORD_FIELDS)
+    """
+    if fields is None:
+        fields = RECORD_FIELDS
+    fields = [f for f in fields if f not in ['position_lat', 'position_long']]
+    metadata = {}
+    errors = set()
+    capacity = max(os.path.getsize(path) // 32, INITIAL_CAPACITY)
+    data = np.full((capacity, len(fields) + 2), np.nan)
+    found = np.zeros(len(fields) + 2, dtype=bool)
+    n = 0
+    for values in iter_fit(path, fields, metadata, errors):
+        if not values[0]:
+            continue
+        if n == len(data):
+            data = np.concatenate([data, np.full(data.shape, np.nan)])
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            try:
+                data[n, i] = value
+                found[i] = True
+            except (TypeError, ValueError):
+                pass
+        n += 1
+    data = data[:n]
+
+    columns = {
+        'lat': to_degree(data[:, 0]),
+        'lon': to_degree(data[:, 1]),
+    }
+    for i, field in enumerate(fields, start=2):
+        if not found[i]:
+            continue
+        if field == 'timestamp':
+            columns[field] = pd.to_datetime(data[:, i], unit='s', utc=True)
+        else:
+            columns[field] = data[:, i].copy()
+    return columns, metadata, errors
@@ -0,0 +1,257 @@
+"""Vectorized distance and bearing calculations"""
+
+import math
+import numpy as np
+
+
+EARTH_RADIUS = 6371008.8  # mean earth radius (m)
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Calculate great-circle distance (m) between arrays of lat-lon points.
+
+    Uses a sphere with the mean earth radius. Compared to geodesic distance
+    on the WGS-84 ellipsoid, the error is at most about 0.6%.
+    """
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(v, dtype=float))
+        for v in (lat1, lon1, lat2, lon2)
+    )
+    a = np.sin((lat2 - lat1) / 2) ** 2
+    a += np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def vincenty(lat1, lon1, lat2, lon2, max_iter=20, tol=1e-12):
+    """Calculate distance (m) between arrays of lat-lon points on the WGS-84
+    ellipsoid, using Vincenty's inverse formula.
+
+    Results match geopy.distance.distance (geodesic) within 1 mm, except for
+    nearly antipodal points, where the iteration may not converge.
+    """
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(v, dtype=float))
+        for v in (lat1, lon1, lat2, lon2)
+    )
+    f = WGS84_F
+    diff_lon = lon2 - lon1
+    u1 = np.arctan((1 - f) * np.tan(lat1))
+    u2 = np.arctan((1 - f) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    lam = diff_lon
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(max_iter):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt(
+                (cos_u2 * sin_lam) ** 2
+                + (cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam) ** 2
+            )
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(
+                sin_sigma == 0, 0, cos_u1 * cos_u2 * sin_lam / sin_sigma
+            )
+            cos2_alpha = 1 - sin_alpha ** 2
+            # cos2_alpha is zero for points on the equator
+            cos_2sigma_m = np.where(
+                cos2_alpha == 0, 0,
+                cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha
+            )
+            c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = diff_lon + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (
+                    cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+                )
+            )
+            if np.all(np.abs(lam - lam_prev) < tol):
+                break
+
+    u_sq = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = b * sin_sigma * (
+        cos_2sigma_m + b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - b / 6 * cos_2sigma_m
+            * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+        )
+    )
+    return WGS84_B * a * (sigma - delta_sigma)
+
+
+DISTANCE_MODELS = {
+    'haversine': haversine,
+    'ellipsoidal': vincenty,
+}
+
+
+def get_distance_function(model):
+    """Return distance function for distance model"""
+    try:
+        return DISTANCE_MODELS[model]
+    except KeyError:
+        raise Exception(f'Distance model {model} not implemented') from None
+
+
+# vectorized version of the bearing calculation from
+# https://github.com/gboeing/osmnx/
+def bearing(lat1, lon1, lat2, lon2):
+    """Calculate the bearing between arrays of lat-lon points."""
+    lat1 = np.radians(np.asarray(lat1, dtype=float))
+    lat2 = np.radians(np.asarray(lat2, dtype=float))
+    diff_lng = np.radians(
+        np.asarray(lon2, dtype=float) - np.asarray(lon1, dtype=float)
+    )
+    x = np.sin(diff_lng) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2)
+    y -= np.sin(lat1) * np.cos(lat2) * np.cos(diff_lng)
+    initial_bearing = np.degrees(np.arctan2(x, y))
+    return (initial_bearing + 360) % 360
+
+
+class PointIndex():
+    """Index of lat-lon points sorted by latitude, to find the point nearest
+    to a location without calculating the distance to every point.
+    """
+    def __init__(self, lats, lons, distance_model='ellipsoidal'):
+        """
+        :param lats: array of latitudes
+        :param lons: array of longitudes
+        :param distance_model: 'ellipsoidal' or 'haversine'
+        """
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.distance = get_distance_function(distance_model)
+        self.order = np.argsort(self.lats, kind='stable')
+        self.lats_sorted = self.lats[self.order]
+
+
+    def candidates(self, lat, lon, threshold):
+        """Return sorted indices of points within bounding box of threshold
+        (m) around location."""
+        # one degree of latitude is at least 110574 m
+        dlat = threshold / 110574
+        lo = np.searchsorted(self.lats_sorted, lat - dlat, side='left')
+        hi = np.searchsorted(self.lats_sorted, lat + dlat, side='right')
+        idx = self.order[lo:hi]
+        cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 90)))
+        if cos_lat > 0:
+            dlon = dlat / cos_lat
+            diff_lon = np.abs((self.lons[idx] - lon + 180) % 360 - 180)
+            idx = idx[diff_lon <= dlon]
+        return np.sort(idx)
+
+
+    def nearest(self, lat, lon, threshold):
+        """Return index of and distance (m) to the point nearest to location.
+
+        Only points within threshold (m) are considered; if there are none,
+        (None, inf) is returned. If several points are equally near, the
+        first is returned.
+        """
+        idx = self.candidates(lat, lon, threshold)
+        if not len(idx):
+            return None, math.inf
+        distances = self.distance(self.lats[idx], self.lons[idx], lat, lon)
+        i = np.argmin(distances)
+        if not distances[i] < threshold:
+            return None, math.inf
+        return int(idx[i]), float(distances[i])
+
+
+def nearest_points(lats, lons, point_lats, point_lons, k=1,
+                   distance_model='ellipsoidal', chunk_size=10000):
+    """Return indices of and distances (m) to the k points nearest to each
+    location, nearest first, as two arrays of shape (locations, k).
+
+    Distances from each location to all points are calculated as a matrix,
+    one chunk of locations at a time, which is efficient for a small set of
+    points such as weather stations.
+    :param lats: array of latitudes of locations
+    :param lons: array of longitudes of locations
+    :param point_lats: array of latitudes of points
+    :param point_lons: array of longitudes of points
+    :param k: number of points to return per location
+    :param distance_model: 'ellipsoidal' or 'haversine'
+    :param chunk_size: number of locations per distance matrix
+    """
+    distance = get_distance_function(distance_model)
+    lats = np.atleast_1d(np.asarray(lats, dtype=float))
+    lons = np.atleast_1d(np.asarray(lons, dtype=float))
+    point_lats = np.asarray(point_lats, dtype=float)
+    point_lons = np.asarray(point_lons, dtype=float)
+    k = min(k, len(point_lats))
+    indices = np.empty((len(lats), k), dtype=int)
+    distances = np.empty((len(lats), k))
+    for start in range(0, len(lats), chunk_size):
+        end = start + chunk_size
+        matrix = distance(
+            lats[start:end, None], lons[start:end, None],
+            point_lats[None, :], point_lons[None, :],
+        )
+        if k < len(point_lats):
+            idx = np.argpartition(matrix, k - 1, axis=1)[:, :k]
+        else:
+            idx = np.broadcast_to(np.arange(k), matrix.shape)
+        dist = np.take_along_axis(matrix, idx, axis=1)
+        order = np.argsort(dist, axis=1, kind='stable')
+        indices[start:end] = np.take_along_axis(idx, order, axis=1)
+        distances[start:end] = np.take_along_axis(dist, order, axis=1)
+    return indices, distances
+
+
+def douglas_peucker(lats, lons, tolerance=0):
+    """Return the significance (m) of each point of a line according to the
+    Douglas-Peucker algorithm: the line simplified with any tolerance t
+    consists of the points with significance > t. End points have infinite
+    significance; points within tolerance of the simplified line have zero
+    significance.
+
+    Distances are calculated on a local equirectangular projection, which is
+    accurate enough for simplifying lines for display.
+    :param lats: array of latitudes
+    :param lons: array of longitudes
+    :param tolerance: smallest tolerance (m) that will be used; a higher
+        value saves time
+    """
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    n = len(lats)
+    significance = np.zeros(n)
+    if not n:
+        return significance
+    significance[[0, -1]] = np.inf
+    cos_lat = math.cos(math.radians(np.mean(lats)))
+    x = np.radians(lons) * EARTH_RADIUS * cos_lat
+    y = np.radians(lats) * EARTH_RADIUS
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        i, j, parent = stack.pop()
+        if j - i < 2:
+            continue
+        dx = x[j] - x[i]
+        dy = y[j] - y[i]
+        px = x[i + 1: j] - x[i]
+        py = y[i + 1: j] - y[i]
+        length = math.hypot(dx, dy)
+        if length:
+            distances = np.abs(dx * py - dy * px) / length
+        else:
+            distances = np.hypot(px, py)
+        k = int(np.argmax(distances))
+        if not distances[k] > tolerance:
+            continue
+        # a point is only kept if the point that split its part of the line
+        # is kept as well
+        value = min(distances[k], parent)
+        k += i + 1
+        significance[k] = value
+        stack.append((i, k, value))
+        stack.append((k, j, value))
+    return significance
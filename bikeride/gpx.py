@@ -0,0 +1,103 @@
+"""Read trackpoints and metadata from .gpx files incrementally"""
+
+from array import array
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+
+
+# local tag name of trackpoint child elements and corresponding record keys
+TRKPT_FIELDS = {
+    'ele': 'altitude',
+    'atemp': 'temperature_recorded',
+    'cad': 'cadence',
+}
+
+
+def local_name(tag):
+    """Return tag without namespace"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_gpx(path, metadata, errors):
+    """Yield a tuple (lat, lon, time, ele, atemp, cad) for each trackpoint in
+    .gpx file, with time as string and None for missing values.
+
+    Trackpoints are removed from the tree once they have been processed, so
+    memory use doesn't depend on the size of the file. The author of the
+    file is stored in metadata; errors are added to errors.
+    """
+    stack = []
+    in_author = False
+    try:
+        for event, elem in ET.iterparse(path, events=('start', 'end')):
+            name = local_name(elem.tag)
+            if event == 'start':
+                stack.append(elem)
+                if name == 'author':
+                    in_author = True
+                continue
+            stack.pop()
+            if name == 'author':
+                in_author = False
+            elif in_author and name == 'text':
+                metadata.setdefault('author', elem.text)
+            elif name == 'trkpt':
+                values = {'time': None, 'ele': None, 'atemp': None, 'cad': None}
+                for child in elem.iter():
+                    child_name = local_name(child.tag)
+                    if child_name in values and values[child_name] is None:
+                        values[child_name] = child.text
+                yield (
+                    elem.get('lat'),
+                    elem.get('lon'),
+                    values['time'],
+                    values['ele'],
+                    values['atemp'],
+                    values['cad'],
+                )
+                elem.clear()
+                if stack:
+                    stack[-1].remove(elem)
+    except ET.ParseError as e:
+        errors.add(str(e))
+
+
+def read_gpx(path):
+    """Read trackpoints and metadata from .gpx file.
+
+    Returns a dict of arrays with lat, lon and, if present in any trackpoint,
+    timestamp, altitude, temperature_recorded and cadence; a dict with
+    metadata (author) and a set of errors.
+    :param path: path to .gpx file
+    """
+    metadata = {}
+    errors = set()
+    lats = array('d')
+    lons = array('d')
+    times = []
+    fields = {name: array('d') for name in TRKPT_FIELDS}
+    found = set()
+    for lat, lon, time, *values in iter_gpx(str(path), metadata, errors):
+        lats.append(float(lat))
+        lons.append(float(lon))
+        times.append(time)
+        for name, value in zip(TRKPT_FIELDS, values):
+            if value is None:
+                fields[name].append(np.nan)
+            else:
+                fields[name].append(float(value))
+                found.add(name)
+
+    columns = {
+        'lat': np.frombuffer(lats, dtype=float),
+        'lon': np.frombuffer(lons, dtype=float),
+    }
+    if any(times):
+        columns['timestamp'] = pd.to_datetime(
+            times, utc=True, format='ISO8601'
+        )
+    for name, key in TRKPT_FIELDS.items():
+        if name in found:
+            columns[key] = np.frombuffer(fields[name], dtype=float)
+    return columns, metadata, errors
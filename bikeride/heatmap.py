@@ -0,0 +1,248 @@
+"""Create density heatmaps of many rides as a pyramid of map tiles"""
+
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+from pathlib import Path
+import struct
+import threading
+import zlib
+import numpy as np
+from bikeride.bikeride import BikeRide
+from bikeride.plot import get_leaflet
+
+
+TILE_SIZE = 256
+# web mercator can only show latitudes up to about 85 degrees
+MAX_LAT = 85.0511287798
+# colours for lowest and highest density (rgb)
+COLOUR_LOW = (255, 237, 160)
+COLOUR_HIGH = (240, 59, 32)
+
+
+def project(lats, lons, zoom):
+    """Return web mercator pixel coordinates (x, y) of positions at zoom
+    level, as integer arrays."""
+    lats = np.clip(np.asarray(lats, dtype=float), -MAX_LAT, MAX_LAT)
+    lons = np.asarray(lons, dtype=float)
+    size = TILE_SIZE * 2 ** zoom
+    x = (lons + 180) / 360 * size
+    lat_rad = np.radians(lats)
+    y = (1 - np.log(np.tan(lat_rad) + 1 / np.cos(lat_rad)) / math.pi) / 2
+    y *= size
+    x = np.clip(x, 0, size - 1).astype(np.int64)
+    y = np.clip(y, 0, size - 1).astype(np.int64)
+    return x, y
+
+
+def write_png(path, rgba):
+    """Write array of shape (height, width, 4) with uint8 rgba values to png
+    file."""
+    height, width = rgba.shape[:2]
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, -1)
+
+    def chunk(tag, data):
+        crc = zlib.crc32(tag + data) & 0xffffffff
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+
+    png = b'\x89PNG\r\n\x1a\n'
+    png += chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+    png += chunk(b'IDAT', zlib.compress(raw.tobytes(), 6))
+    png += chunk(b'IEND', b'')
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_bytes(png)
+    tmp_path.replace(path)
+
+
+def render(counts, saturation):
+    """Return rgba array for tile of counts. Colour and opacity increase with
+    the logarithm of the count, up to the saturation count."""
+    level = np.clip(np.log1p(counts) / math.log1p(saturation), 0, 1)
+    rgba = np.zeros(counts.shape + (4,), dtype=np.uint8)
+    for i, (low, high) in enumerate(zip(COLOUR_LOW, COLOUR_HIGH)):
+        rgba[..., i] = low + (high - low) * level
+    rgba[..., 3] = np.where(counts > 0, 96 + 159 * level, 0)
+    return rgba
+
+
+class Heatmap():
+    """Density of the records of many rides, binned into web mercator tiles
+    at several zoom levels and stored in a directory as count arrays
+    (z/x/y.npy) and png images (z/x/y.png).
+
+    Rides can be added incrementally; only the tiles they touch are updated.
+    """
+    def __init__(self, directory, min_zoom=None, max_zoom=None,
+                 saturation=None):
+        """
+        :param directory: directory to store tiles in
+        :param min_zoom: lowest zoom level (defaults to 5)
+        :param max_zoom: highest zoom level (defaults to 14)
+        :param saturation: number of records in a pixel that gets the
+            highest colour (defaults to 100)
+        Settings of an existing heatmap in directory are used unless they are
+        passed.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        settings = {
+            'min_zoom': 5, 'max_zoom': 14, 'saturation': 100, 'rides': [],
+        }
+        path = self.directory / 'heatmap.json'
+        if path.exists():
+            settings.update(json.loads(path.read_text()))
+        for name, value in [('min_zoom', min_zoom), ('max_zoom', max_zoom)]:
+            if value is None or value == settings[name]:
+                continue
+            if settings['rides']:
+                raise Exception(
+                    f'Heatmap in {directory} has {name} {settings[name]}'
+                )
+            settings[name] = value
+        self.min_zoom = settings['min_zoom']
+        self.max_zoom = settings['max_zoom']
+        self.saturation = saturation or settings['saturation']
+        self.rides = set(settings['rides'])
+        self.tiles = {}
+        self.server = None
+
+
+    def get_path(self, zoom, x, y, suffix):
+        """Return path of tile file"""
+        return self.directory / str(zoom) / str(x) / f'{y}{suffix}'
+
+
+    def get_tile(self, zoom, x, y):
+        """Return array of counts for tile, from memory or disk"""
+        key = (zoom, x, y)
+        if key not in self.tiles:
+            path = self.get_path(zoom, x, y, '.npy')
+            if path.exists():
+                self.tiles[key] = np.load(path)
+            else:
+                self.tiles[key] = np.zeros((TILE_SIZE, TILE_SIZE), np.uint32)
+        return self.tiles[key]
+
+
+    def add(self, lats, lons):
+        """Add positions to heatmap (tiles are stored when save is called)"""
+        if not len(lats):
+            return
+        x_max, y_max = project(lats, lons, self.max_zoom)
+        shift_tile = int(math.log2(TILE_SIZE))
+        for zoom in range(self.min_zoom, self.max_zoom + 1):
+            shift = self.max_zoom - zoom
+            x = x_max >> shift
+            y = y_max >> shift
+            n_tiles = 2 ** zoom
+            pixel = (y & (TILE_SIZE - 1)) * TILE_SIZE + (x & (TILE_SIZE - 1))
+            tile = (x >> shift_tile) * n_tiles + (y >> shift_tile)
+            keys, counts = np.unique(
+                tile * TILE_SIZE ** 2 + pixel, return_counts=True
+            )
+            tiles = keys // TILE_SIZE ** 2
+            pixels = keys % TILE_SIZE ** 2
+            bounds = np.flatnonzero(np.diff(tiles)) + 1
+            for start, end in zip(
+                np.concatenate([[0], bounds]),
+                np.concatenate([bounds, [len(keys)]]),
+            ):
+                tile_x, tile_y = divmod(int(tiles[start]), n_tiles)
+                array = self.get_tile(zoom, tile_x, tile_y)
+                array.ravel()[pixels[start:end]] += counts[start:end].astype(
+                    np.uint32
+                )
+
+
+    def add_ride(self, ride, key=None):
+        """Add records of ride, unless a ride with the same key has been
+        added before. Returns True if the ride was added.
+
+        :param ride: BikeRide object
+        :param key: key to identify ride (defaults to path of gps file)
+        """
+        key = key or str(ride.path_ride)
+        if key in self.rides:
+            return False
+        self.add(ride.track['lat'], ride.track['lon'])
+        self.rides.add(key)
+        return True
+
+
+    def add_rides(self, rides, **kwargs):
+        """Add rides and save tiles. Returns number of rides added.
+
+        :param rides: BikeRide objects or paths to gps files
+        :param kwargs: parameters passed on to BikeRide for paths
+        """
+        added = 0
+        for ride in rides:
+            if not isinstance(ride, BikeRide):
+                if str(ride) in self.rides:
+                    continue
+                ride = BikeRide(ride, lazy=True, **kwargs)
+            added += self.add_ride(ride)
+        self.save()
+        return added
+
+
+    def save(self):
+        """Store count arrays and png images of updated tiles on disk."""
+        for (zoom, x, y), counts in self.tiles.items():
+            path = self.get_path(zoom, x, y, '.npy')
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path.with_suffix('.tmp'), 'wb') as f:
+                np.save(f, counts)
+            path.with_suffix('.tmp').replace(path)
+            write_png(
+                self.get_path(zoom, x, y, '.png'),
+                render(counts, self.saturation),
+            )
+        self.tiles = {}
+        settings = {
+            'min_zoom': self.min_zoom,
+            'max_zoom': self.max_zoom,
+            'saturation': self.saturation,
+            'rides': sorted(self.rides),
+        }
+        (self.directory / 'heatmap.json').write_text(json.dumps(settings))
+
+
+    def serve(self, port=0):
+        """Serve tiles over http in a background thread and return url
+        template for tiles."""
+        if self.server is None:
+            handler = partial(QuietHandler, directory=str(self.directory))
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+            thread = threading.Thread(
+                target=self.server.serve_forever, daemon=True
+            )
+            thread.start()
+        port = self.server.server_address[1]
+        return f'http://127.0.0.1:{port}/{{z}}/{{x}}/{{y}}.png'
+
+
+    def layer(self, port=0, **kwargs):
+        """Return ipyleaflet TileLayer showing heatmap, served from local
+        directory. At zoom levels above max_zoom, tiles of max_zoom are
+        scaled.
+
+        :param port: port to serve tiles on (defaults to a free port)
+        :param kwargs: parameters passed on to TileLayer
+        """
+        return get_leaflet().TileLayer(
+            url=self.serve(port),
+            min_zoom=self.min_zoom,
+            max_native_zoom=self.max_zoom,
+            name='heatmap',
+            attribution='',
+            **kwargs,
+        )
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """Request handler that doesn't log requests"""
+    def log_message(self, format, *args):
+        pass
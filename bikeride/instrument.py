@@ -0,0 +1,122 @@
+"""Record time and memory used by the pipeline stages of rides"""
+
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+
+class StageRecorder():
+    """Measure wall time and optionally peak memory allocation of pipeline
+    stages. Stages may be computed while another stage is computed (e.g. the
+    summary needs segments); the time of such nested stages is included in
+    seconds of the outer stage, but not in its own_seconds.
+    """
+    def __init__(self, memory=False, hooks=None):
+        """
+        :param memory: if True, also measure peak memory allocated by each
+            stage with tracemalloc, which makes stages several times slower
+        :param hooks: functions that are called with a dict of stats each
+            time a stage has been computed
+        """
+        self.memory = memory
+        self.hooks = list(hooks or [])
+        self.stack = []
+        self.started_tracing = False
+
+
+    def run(self, func):
+        """Call func and return its result and a dict with seconds,
+        own_seconds and (if memory is measured) peak_bytes."""
+        frame = {'nested': 0.0, 'peak': 0, 'memory': 0}
+        if self.memory:
+            if not self.stack and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame['memory'] = current
+        self.stack.append(frame)
+        start = time.perf_counter()
+        try:
+            result = func()
+            seconds = time.perf_counter() - start
+            stats = {
+                'seconds': seconds,
+                'own_seconds': seconds - frame['nested'],
+            }
+            if self.memory:
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                stats['peak_bytes'] = peak - frame['memory']
+        finally:
+            self.stack.pop()
+            if self.stack:
+                self.stack[-1]['nested'] += time.perf_counter() - start
+                if self.memory:
+                    self.stack[-1]['peak'] = max(
+                        self.stack[-1]['peak'],
+                        tracemalloc.get_traced_memory()[1],
+                    )
+            elif self.started_tracing:
+                tracemalloc.stop()
+                self.started_tracing = False
+        return result, stats
+
+
+    def notify(self, stats):
+        """Call hooks with stats of a stage"""
+        for hook in self.hooks:
+            hook(stats)
+
+
+class StatsCollector():
+    """Hook that collects the stats of stages of many rides, e.g. to find
+    out which stage takes most time when processing a library.
+
+    Usage: collector = StatsCollector(); BikeRide(path, hooks=[collector])
+    """
+    def __init__(self):
+        self.rows = []
+
+
+    def __call__(self, stats):
+        self.rows.append(stats)
+
+
+    @property
+    def table(self):
+        """Dataframe with a row for each stage of each ride"""
+        return pd.DataFrame(self.rows)
+
+
+    def summary(self, column='own_seconds'):
+        """Return dataframe with count, total, mean, median, 95th percentile
+        and maximum of column for each stage.
+
+        :param column: 'own_seconds', 'seconds' or 'peak_bytes'
+        """
+        grouped = self.table.groupby('stage')[column]
+        summary = grouped.agg(['count', 'sum', 'mean', 'median', 'max'])
+        summary.insert(4, 'p95', grouped.quantile(0.95))
+        return summary.rename(columns={'sum': 'total'}).sort_values(
+            'total', ascending=False
+        )
+
+
+    def histogram(self, stage, bins=10, column='own_seconds'):
+        """Return series with number of rides per bin of column for stage,
+        indexed by bin intervals.
+
+        :param stage: name of stage, e.g. 'columns'
+        :param bins: number of bins or bin edges, as accepted by
+            np.histogram
+        :param column: 'own_seconds', 'seconds' or 'peak_bytes'
+        """
+        table = self.table
+        values = table.loc[table.stage == stage, column].dropna()
+        counts, edges = np.histogram(values, bins)
+        return pd.Series(
+            counts, index=pd.IntervalIndex.from_breaks(edges), name=stage
+        )
@@ -1,12 +1,18 @@
 """Download hourly weather data from Royal Dutch Meteorological Institute"""
 
-import math
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import io
+from pathlib import Path
+import numpy as np
 import pandas as pd
-import geopy.distance
+from bikeride.download import get_session
+from bikeride.geo import nearest_points
 
 
 URL = 'https://www.daggegevens.knmi.nl/klimatologie/uurgegevens'
+# number of days requested at once; KNMI limits the amount of data per
+# request
+CHUNK_DAYS = 365
 RENAME_COLS = {
     '# STN': 'station',
     'YYYYMMDD': 'date',
@@ -98,61 +104,266 @@ STATIONS = [
 ]
 
 
-def get_station(lat_loc, lon_loc):
-    """Find nearest station for location"""
-    shortest_distance = math.inf
-    for station_id, lon_st, lat_st, station_name in STATIONS:
-        distance = geopy.distance.distance((lat_loc, lon_loc), (lat_st, lon_st))
-        if distance < shortest_distance:
-            nearest_station = station_id, station_name, lat_st, lon_st
-            shortest_distance = distance
-    return nearest_station
+# station table, built once for nearest station lookups
+STATION_IDS = np.array([station[0] for station in STATIONS])
+STATION_LONS = np.array([station[1] for station in STATIONS])
+STATION_LATS = np.array([station[2] for station in STATIONS])
+STATION_NAMES = np.array([station[3] for station in STATIONS])
+
+
+def nearest_stations(lats, lons, k=1):
+    """Find the k nearest stations for each location, e.g. to fall back to
+    another station if the nearest station has gaps in its data.
 
+    Returns a dataframe with a row per location and rank (0 for the nearest
+    station), with columns location (position in lats and lons), rank,
+    station, name, lat, lon and distance (m).
+    :param lats: latitude or array of latitudes of locations
+    :param lons: longitude or array of longitudes of locations
+    :param k: number of stations per location
+    """
+    indices, distances = nearest_points(
+        lats, lons, STATION_LATS, STATION_LONS, k=k
+    )
+    n_locations, k = indices.shape
+    indices = indices.ravel()
+    return pd.DataFrame({
+        'location': np.repeat(np.arange(n_locations), k),
+        'rank': np.tile(np.arange(k), n_locations),
+        'station': STATION_IDS[indices],
+        'name': STATION_NAMES[indices],
+        'lat': STATION_LATS[indices],
+        'lon': STATION_LONS[indices],
+        'distance': distances.ravel(),
+    })
 
-def add_day(date):
-    """Add day to date"""
-    dt = pd.to_datetime(date, format='%Y%m%d')
-    dt += pd.Timedelta(days=1)
-    return dt.strftime('%Y%m%d')
+
+def get_station(lat_loc, lon_loc):
+    """Find nearest station for location"""
+    nearest = nearest_stations(lat_loc, lon_loc).iloc[0]
+    return (
+        int(nearest.station), nearest['name'], float(nearest.lat),
+        float(nearest.lon),
+    )
 
 
 def process_knmi(text):
-    """Process response text from KNMI"""
-    lines = text.split('\n')
-    colnames = []
-    rows = []
-    for line in lines:
-        if line.startswith('# STN,YYYYMMDD'):
-            colnames = line.split(',')[:-2]
-        if not colnames:
-            continue
-        if not line.startswith('#'):
-            values = [v.strip() for v in line.split(',')]
-            if len(values) != len(colnames):
-                continue
-            row = {k: values[i] for i, k in enumerate(colnames)}
-            rows.append(row)
-    df = pd.DataFrame(rows)
-    df.columns = [c.strip() for c in df.columns]
+    """Process response text from KNMI.
+
+    Returns a dataframe indexed by UTC timestamp (the end of the hour the
+    data refer to), with integer station, date (yyyymmdd) and hour columns
+    and float columns for the weather variables. Hour 24 is converted to
+    hour 0 of the next day, calm and variable wind directions (0 and 990)
+    are set to missing and variables in tenths of units are scaled.
+    """
+    header_start = text.find('# STN,YYYYMMDD')
+    if header_start == -1:
+        return pd.DataFrame()
+    header_end = text.find('\n', header_start)
+    if header_end == -1:
+        header_end = len(text)
+    colnames = [
+        c.strip() for c in text[header_start:header_end].split(',')[:-2]
+    ]
+    # skip comments and rows that don't match the header
+    n_commas = len(colnames) - 1
+    lines = [
+        line for line in text[header_end + 1:].splitlines()
+        if line.count(',') == n_commas and not line.startswith('#')
+    ]
+    if lines:
+        df = pd.read_csv(
+            io.StringIO('\n'.join(lines)),
+            header=None,
+            names=colnames,
+            dtype=float,
+            skipinitialspace=True,
+        )
+    else:
+        df = pd.DataFrame(columns=colnames, dtype=float)
     rename_cols = {k: v for k, v in RENAME_COLS.items() if v != ''}
     df = df.rename(columns=rename_cols)
-    mask = df.hour == '24'
-    df.loc[mask, 'date'] = df.loc[mask, 'date'].apply(add_day)
-    df.loc[mask, 'hour'] = '00'
-    mask = df.wind_direction.isin(['0', '990'])
-    df.loc[mask, 'wind_direction'] = None
+    timestamp = pd.to_datetime(
+        df.date.astype('int64').astype(str), format='%Y%m%d', utc=True
+    ) + pd.to_timedelta(df.hour, unit='h')
+    df['station'] = df.station.astype('int64')
+    df['date'] = (
+        timestamp.dt.year * 10000 + timestamp.dt.month * 100
+        + timestamp.dt.day
+    ).astype('int64')
+    df['hour'] = timestamp.dt.hour.astype('int64')
+    df['wind_direction'] = df.wind_direction.mask(
+        df.wind_direction.isin([0, 990])
+    )
     for var in ADJUST:
-        df[var] = df[var].apply(int)
         df[var] /= 10
-    df['air_pressure'] = 100 * df.air_pressure.apply(float)
+    df['air_pressure'] *= 100
+    df.index = pd.DatetimeIndex(timestamp, name='timestamp')
     return df
 
 
-def get_knmi(lat, lon, start, end):
-    """Download hourly weather data from KNMI"""
+def split_days(days, chunk_days):
+    """Split sorted dates into ranges (first, last) of consecutive dates of
+    at most chunk_days days."""
+    ranges = []
+    for day in days:
+        if ranges and (
+            day - ranges[-1][1] == pd.Timedelta(days=1)
+            and (day - ranges[-1][0]).days < chunk_days
+        ):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [tuple(r) for r in ranges]
+
+
+def get_last_date(text):
+    """Return last date (yyyymmdd) in response text, or None if it contains
+    no data."""
+    for line in reversed(text.splitlines()):
+        if line.strip() and not line.startswith('#'):
+            return line.split(',')[1].strip()
+    return None
+
+
+def get_complete_text(text):
+    """Return response text without the rows of the last day if that day is
+    incomplete (hour 24 is missing, e.g. because it isn't published yet),
+    and the last date (yyyymmdd) in it, or None if no day is complete."""
+    lines = text.splitlines(keepends=True)
+    for i in range(len(lines) - 1, -1, -1):
+        line = lines[i]
+        if line.strip() and not line.startswith('#'):
+            values = line.split(',')
+            if values[2].strip() == '24':
+                return ''.join(lines[:i + 1]), values[1].strip()
+    return text, None
+
+
+class KnmiClient():
+    """Download hourly weather data from KNMI.
+
+    Long date ranges are split into chunks that are downloaded concurrently
+    over a session that reuses connections and retries failed requests. If a
+    cache directory is set, responses are stored per station and date range,
+    and only days that are not in the cache yet are downloaded.
+    """
+    def __init__(self, url=URL, cache_dir=None, workers=4,
+                 chunk_days=CHUNK_DAYS, retries=3, backoff_factor=0.5,
+                 timeout=60):
+        """
+        :param url: url of KNMI service (e.g. of a local server for testing)
+        :param cache_dir: directory to store responses in
+        :param workers: maximum number of concurrent requests
+        :param chunk_days: maximum number of days per request
+        :param retries: maximum number of retries per request
+        :param backoff_factor: backoff factor (s) between retries
+        :param timeout: timeout (s) per request
+        """
+        self.url = url
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self.chunk_days = chunk_days
+        self.timeout = timeout
+        self.session = get_session(
+            retries=retries, backoff_factor=backoff_factor, pool_size=workers
+        )
+
+
+    def fetch(self, station_id, first, last):
+        """Download response text for station from first to last date"""
+        first = first.strftime('%Y%m%d')
+        last = last.strftime('%Y%m%d')
+        r = self.session.post(
+            self.url,
+            data=f'start={first}01&end={last}24&stns={station_id}',
+            timeout=self.timeout,
+        )
+        r.raise_for_status()
+        return r.text
+
+
+    def get_cache_path(self, station_id, first, last):
+        """Return path of cache file for station and date range"""
+        return self.cache_dir / (
+            f'knmi-{station_id}-{first:%Y%m%d}-{last:%Y%m%d}.txt'
+        )
+
+
+    def get_cached(self, station_id):
+        """Return dict with (first, last) date range of each cache file of
+        station, and its path."""
+        if not self.cache_dir:
+            return {}
+        cached = {}
+        for path in self.cache_dir.glob(f'knmi-{station_id}-*.txt'):
+            first, last = path.stem.split('-')[2:]
+            first = pd.Timestamp(first)
+            last = pd.Timestamp(last)
+            cached[(first, last)] = path
+        return cached
+
+
+    def download(self, station_id, first, last):
+        """Download response text for chunk, and store the days it contains
+        in the cache."""
+        text = self.fetch(station_id, first, last)
+        complete_text, last_date = get_complete_text(text)
+        if self.cache_dir and last_date:
+            # only cache complete days, so days that have no data yet or
+            # are still being published are downloaded again next time
+            last = min(last, pd.Timestamp(last_date))
+            path = self.get_cache_path(station_id, first, last)
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_text(complete_text)
+            tmp_path.replace(path)
+        return text
+
+
+    def get_texts(self, station_id, start, end):
+        """Return response texts, from cache or downloaded, covering all days
+        from start to end."""
+        days = pd.date_range(start, end, freq='D')
+        cached = self.get_cached(station_id)
+        covered = np.zeros(len(days), dtype=bool)
+        texts = []
+        for (first, last), path in cached.items():
+            in_range = (days >= first) & (days <= last)
+            if in_range.any():
+                covered |= in_range
+                texts.append(path.read_text())
+        chunks = split_days(days[~covered], self.chunk_days)
+        if chunks:
+            workers = min(self.workers, len(chunks))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                texts += executor.map(
+                    lambda chunk: self.download(station_id, *chunk), chunks
+                )
+        return texts
+
+
+    def get_data(self, station_id, start, end):
+        """Return dataframe with hourly weather data for station from start
+        to end date (yyyymmdd)."""
+        texts = self.get_texts(station_id, start, end)
+        dfs = [process_knmi(text) for text in texts if get_last_date(text)]
+        if not dfs:
+            return pd.DataFrame()
+        df = pd.concat(dfs)
+        df = df[~df.index.duplicated()].sort_index()
+        first = pd.Timestamp(start, tz='UTC') + pd.Timedelta(hours=1)
+        last = pd.Timestamp(end, tz='UTC') + pd.Timedelta(days=1)
+        return df[first:last]
+
+
+def get_knmi(lat, lon, start, end, **kwargs):
+    """Download hourly weather data from KNMI
+
+    :param kwargs: parameters passed on to KnmiClient, e.g. cache_dir
+    """
     station_id, station_name, lat, lon = get_station(lat, lon)
     print(f'Using station {station_id} {station_name} {lat},{lon}')
-    data = f'start={start}01&end={end}24&stns={station_id}'
-    r = requests.post(URL, data=data)
-    text = r.text
-    return process_knmi(text)
+    client = KnmiClient(**kwargs)
+    return client.get_data(station_id, start, end)
@@ -0,0 +1,267 @@
+"""Index the records of a library of rides by grid cell, to find rides that
+pass through a section of a route without parsing every gps file"""
+
+from functools import partial
+import json
+import math
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from bikeride.bikeride import BikeRide
+from bikeride.collection import get_error, map_paths
+
+
+# size (degrees) of grid cells; about 550 m north-south
+CELL_SIZE = 0.005
+# approximate length (m) of a degree of latitude
+DEGREE_LENGTH = 111_320
+
+
+def get_cells(lats, lons, cell_size=CELL_SIZE):
+    """Return array with number of grid cell of each position (-1 for missing
+    positions)."""
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+    n_cols = math.ceil(360 / cell_size)
+    missing = np.isnan(lats) | np.isnan(lons)
+    rows = np.floor((np.nan_to_num(lats) + 90) / cell_size).astype(np.int64)
+    cols = np.floor((np.nan_to_num(lons) + 180) / cell_size).astype(np.int64)
+    return np.where(missing, -1, rows * n_cols + cols % n_cols)
+
+
+def get_cell_runs(cells):
+    """Return cell, first index and last index (exclusive) of each run of
+    consecutive records in the same cell, excluding missing positions."""
+    cells = np.asarray(cells)
+    if not len(cells):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(cells)) + 1])
+    ends = np.append(starts[1:], len(cells))
+    keep = cells[starts] >= 0
+    return cells[starts][keep], starts[keep], ends[keep]
+
+
+def cells_near(lat, lon, threshold, cell_size=CELL_SIZE):
+    """Return array with numbers of grid cells within threshold (m) of
+    position (and possibly a bit further)."""
+    d_lat = threshold / DEGREE_LENGTH
+    d_lon = threshold / (
+        DEGREE_LENGTH * max(math.cos(math.radians(lat)), 1e-6)
+    )
+    n_cols = math.ceil(360 / cell_size)
+    rows = np.arange(
+        math.floor((lat - d_lat + 90) / cell_size),
+        math.floor((lat + d_lat + 90) / cell_size) + 1,
+    )
+    cols = np.arange(
+        math.floor((lon - d_lon + 180) / cell_size),
+        math.floor((lon + d_lon + 180) / cell_size) + 1,
+    ) % n_cols
+    return np.unique((rows[:, None] * n_cols + cols[None, :]).ravel())
+
+
+def index_ride(path, cell_size=CELL_SIZE, **kwargs):
+    """Parse gps file and return dict with its path, number of records and
+    runs of records per cell, or the error if it can't be processed.
+
+    Runs in worker processes.
+    """
+    try:
+        ride = BikeRide(path, lazy=True, **kwargs)
+        track = ride.track
+    except Exception as e:
+        return get_error(path, e)
+    cells, starts, ends = get_cell_runs(
+        get_cells(track['lat'], track['lon'], cell_size)
+    )
+    return {
+        'path': str(path),
+        'records': len(track),
+        'cells': cells,
+        'starts': starts,
+        'ends': ends,
+    }
+
+
+class LibraryIndex():
+    """Index of the records of many gps files by grid cell, stored in a
+    directory (library.json with the indexed files and settings, runs.npz
+    with the runs of consecutive records in each cell).
+
+    Files are only parsed when they are added or have changed, so the index
+    can be updated incrementally. Queries return the rides that pass near
+    the start and end point of a section and the ranges of records near
+    these points, so only those files need to be loaded and truncated.
+    """
+    def __init__(self, directory, cell_size=None):
+        """
+        :param directory: directory to store index in
+        :param cell_size: size (degrees) of grid cells (defaults to 0.005);
+            can't be changed once files have been indexed
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        settings = {'cell_size': CELL_SIZE, 'rides': {}}
+        path = self.directory / 'library.json'
+        if path.exists():
+            settings.update(json.loads(path.read_text()))
+        if cell_size is not None and cell_size != settings['cell_size']:
+            if settings['rides']:
+                raise Exception(
+                    f'Index in {directory} has cell_size '
+                    f'{settings["cell_size"]}'
+                )
+            settings['cell_size'] = cell_size
+        self.cell_size = settings['cell_size']
+        self.rides = settings['rides']
+        self.failures = {}
+        path = self.directory / 'runs.npz'
+        if path.exists():
+            with np.load(path) as runs:
+                self.runs = {name: runs[name] for name in runs.files}
+        else:
+            empty = np.zeros(0, dtype=np.int64)
+            self.runs = {
+                'cell': empty, 'ride': empty, 'start': empty, 'end': empty
+            }
+
+
+    def get_stat(self, path):
+        """Return modification time (ns) and size of file"""
+        stat = os.stat(path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+
+    def update(self, paths, workers=None, **kwargs):
+        """Index files that are new or have changed, and save index. Returns
+        number of files indexed.
+
+        :param paths: paths to gps files
+        :param workers: number of worker processes (defaults to number of
+            cpus); if 1, files are processed in the current process
+        :param kwargs: parameters passed on to BikeRide, e.g. cache
+        """
+        paths = [
+            str(path) for path in paths
+            if str(path) not in self.rides
+            or self.rides[str(path)]['stat'] != self.get_stat(path)
+        ]
+        if not paths:
+            return 0
+        func = partial(index_ride, cell_size=self.cell_size)
+        results = list(map_paths(func, paths, workers, **kwargs))
+        self.remove([result['path'] for result in results])
+        next_id = max([ride['id'] for ride in self.rides.values()], default=-1)
+        new_runs = [self.runs]
+        for result in results:
+            if 'error' in result:
+                self.failures[result['path']] = result['error']
+                continue
+            next_id += 1
+            self.rides[result['path']] = {
+                'id': next_id,
+                'records': result['records'],
+                'stat': self.get_stat(result['path']),
+            }
+            new_runs.append({
+                'cell': result['cells'],
+                'ride': np.full(len(result['cells']), next_id),
+                'start': result['starts'],
+                'end': result['ends'],
+            })
+        self.runs = {
+            name: np.concatenate([runs[name] for runs in new_runs])
+            for name in self.runs
+        }
+        order = np.argsort(self.runs['cell'], kind='stable')
+        self.runs = {name: values[order] for name, values in self.runs.items()}
+        self.save()
+        return len(results)
+
+
+    def remove(self, paths):
+        """Remove files from index (call save to store changes)"""
+        ids = [
+            self.rides.pop(str(path))['id']
+            for path in paths
+            if str(path) in self.rides
+        ]
+        if ids:
+            keep = ~np.isin(self.runs['ride'], ids)
+            self.runs = {name: values[keep] for name, values in self.runs.items()}
+
+
+    def save(self):
+        """Store index on disk"""
+        path = self.directory / 'runs.npz'
+        with open(path.with_suffix('.tmp'), 'wb') as f:
+            np.savez(f, **self.runs)
+        path.with_suffix('.tmp').replace(path)
+        settings = {'cell_size': self.cell_size, 'rides': self.rides}
+        path = self.directory / 'library.json'
+        path.with_suffix('.tmp').write_text(json.dumps(settings))
+        path.with_suffix('.tmp').replace(path)
+
+
+    def near(self, lat, lon, threshold):
+        """Return dataframe with for each ride with records in cells near
+        position the first and last index (exclusive) of these records."""
+        cells = cells_near(lat, lon, threshold, self.cell_size)
+        lo = np.searchsorted(self.runs['cell'], cells, side='left')
+        hi = np.searchsorted(self.runs['cell'], cells, side='right')
+        rows = np.concatenate(
+            [np.arange(a, b) for a, b in zip(lo, hi)] or [np.zeros(0, int)]
+        )
+        runs = pd.DataFrame({
+            'ride': self.runs['ride'][rows],
+            'first': self.runs['start'][rows],
+            'last': self.runs['end'][rows],
+        })
+        return runs.groupby('ride').agg({'first': 'min', 'last': 'max'})
+
+
+    def query(self, start, end, threshold):
+        """Return dataframe with rides that have records in cells near both
+        start and end point, with columns path, records and the ranges of
+        records near the start point (start_first, start_last) and end point
+        (end_first, end_last; last indices are exclusive).
+
+        Because cells are larger than the threshold, rides may be included
+        that don't come within threshold of the points; loading them with
+        limits (see load) gives the exact result.
+        :param start: start point (lat, lon)
+        :param end: end point (lat, lon)
+        :param threshold: max distance (m) from points
+        """
+        near_start = self.near(start[0], start[1], threshold)
+        near_end = self.near(end[0], end[1], threshold)
+        matches = near_start.join(
+            near_end, how='inner', lsuffix='_start', rsuffix='_end'
+        )
+        paths = {ride['id']: path for path, ride in self.rides.items()}
+        records = {ride['id']: ride['records'] for ride in self.rides.values()}
+        return pd.DataFrame({
+            'path': [paths[i] for i in matches.index],
+            'records': [records[i] for i in matches.index],
+            'start_first': matches.first_start.to_numpy(),
+            'start_last': matches.last_start.to_numpy(),
+            'end_first': matches.first_end.to_numpy(),
+            'end_last': matches.last_end.to_numpy(),
+        })
+
+
+    def load(self, start, end, threshold, **kwargs):
+        """Return list of BikeRide objects, truncated to the section between
+        start and end point, for rides found by query. Rides in which start
+        or end point is not found within threshold are left out.
+
+        :param kwargs: parameters passed on to BikeRide
+        """
+        rides = []
+        for path in self.query(start, end, threshold).path:
+            ride = BikeRide(path, limits=[start, end, threshold], **kwargs)
+            if ride.limits_found:
+                rides.append(ride)
+        return rides
@@ -1,8 +1,11 @@
 """Download hourly weather data from oikolab"""
 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
-import requests
+from pathlib import Path
 import pandas as pd
+from bikeride.download import get_session
 
 
 URL = 'https://api.oikolab.com/weather'
@@ -14,6 +17,9 @@ DEFAULT_VARS = [
     'total_precipitation',
     'surface_pressure',
 ]
+# size (degrees) of grid cells locations are snapped to; requests for
+# locations in the same cell are combined
+GRID_SIZE = 0.1
 
 
 def format_date(date):
@@ -23,25 +29,53 @@ def format_date(date):
     return date
 
 
-def get_oikolab(lat, lon, start, end, api_key, variables, freq):
-    """Download hourly weather data from oikolab"""
-    if not variables:
-        variables = DEFAULT_VARS
-    r = requests.get(
-        URL,
-        params={
-            'param': variables,
-            'start': format_date(start),
-            'end': format_date(end),
-            'lat': lat,
-            'lon': lon,
-            'api-key': api_key,
-            'freq': freq
-        }
+def snap(value, grid_size=GRID_SIZE):
+    """Return center of grid cell containing value (or value itself if
+    grid_size is None)"""
+    if not grid_size:
+        return value
+    return round(round(value / grid_size) * grid_size, 6)
+
+
+def to_dates(start, end=None):
+    """Convert first and last date of range (yyyymmdd or yyyy-mm-dd) to
+    timestamps; end defaults to start"""
+    end = end or start
+    return (
+        pd.Timestamp(format_date(str(start))),
+        pd.Timestamp(format_date(str(end))),
     )
-    weather_data = json.loads(r.json()['data'])
+
+
+def month_number(date):
+    """Return number of months since year 0 for date"""
+    return date.year * 12 + date.month - 1
+
+
+def count_months(start, end):
+    """Return number of calendar months in date range"""
+    return month_number(end) - month_number(start) + 1
+
+
+def merge_ranges(ranges):
+    """Merge date ranges (start, end) if that doesn't increase the number of
+    months requested, i.e. if they overlap or the second range starts in
+    the month the first ends in or the month after."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and month_number(start) <= month_number(merged[-1][1]) + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
+
+
+def process_oikolab(data):
+    """Create dataframe indexed by UTC timestamp from oikolab data"""
+    weather_data = json.loads(data)
+    index = pd.to_datetime(weather_data['index'], unit='s', utc=True)
     df = pd.DataFrame(
-        index=pd.to_datetime(weather_data['index'], unit='s'),
+        index=pd.DatetimeIndex(index, name='timestamp'),
         data=weather_data['data'],
         columns=weather_data['columns']
     )
@@ -50,6 +84,168 @@ def get_oikolab(lat, lon, start, end, api_key, variables, freq):
         'wind_direction (deg)': 'wind_direction',
         'wind_speed (m/s)': 'wind_speed'
     })
-    df['date'] = df.index.map(lambda x: x.strftime('%Y%m%d'))
-    df['hour'] = df.index.map(lambda x: x.strftime('%H'))
+    df['date'] = df.index.strftime('%Y%m%d')
+    df['hour'] = df.index.strftime('%H')
     return df
+
+
+class OikolabClient():
+    """Download weather data for many locations and date ranges from oikolab.
+
+    Locations are snapped to grid cells, and date ranges for the same cell
+    are merged where that doesn't increase the number of units used (one
+    unit is one month of one variable at one location). Requests are sent
+    concurrently over a session that reuses connections and retries failed
+    requests; if a cache directory is set, responses are stored on disk.
+    """
+    def __init__(self, api_key, url=URL, variables=None, freq='H',
+                 cache_dir=None, workers=4, grid_size=GRID_SIZE,
+                 max_units=None, retries=3, backoff_factor=0.5, timeout=60):
+        """
+        :param api_key: oikolab api key
+        :param url: url of oikolab api (e.g. of a local server for testing)
+        :param variables: variables to request (defaults to DEFAULT_VARS)
+        :param freq: 'H' for hourly data; 'D' for daily
+        :param cache_dir: directory to store responses in
+        :param workers: maximum number of concurrent requests
+        :param grid_size: size (degrees) of grid cells
+        :param max_units: maximum number of units a call to get_many may use
+            for requests that are not cached
+        :param retries: maximum number of retries per request
+        :param backoff_factor: backoff factor (s) between retries
+        :param timeout: timeout (s) per request
+        """
+        self.api_key = api_key
+        self.url = url
+        self.variables = variables or DEFAULT_VARS
+        self.freq = freq
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self.grid_size = grid_size
+        self.max_units = max_units
+        self.timeout = timeout
+        self.session = get_session(
+            retries=retries, backoff_factor=backoff_factor, pool_size=workers
+        )
+
+
+    def get_params(self, lat, lon, start, end):
+        """Return request parameters, excluding api key"""
+        return {
+            'param': list(self.variables),
+            'start': start.strftime('%Y-%m-%d'),
+            'end': end.strftime('%Y-%m-%d'),
+            'lat': lat,
+            'lon': lon,
+            'freq': self.freq,
+        }
+
+
+    def get_cache_path(self, params):
+        """Return path of cache file for request parameters"""
+        key = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+        return self.cache_dir / f'oikolab-{key.hexdigest()}.json'
+
+
+    def fetch(self, params):
+        """Return data for request from cache, or download it"""
+        path = self.get_cache_path(params) if self.cache_dir else None
+        if path and path.exists():
+            return path.read_text()
+        r = self.session.get(
+            self.url,
+            params={**params, 'api-key': self.api_key},
+            timeout=self.timeout,
+        )
+        r.raise_for_status()
+        data = r.json()['data']
+        if path:
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_text(data)
+            tmp_path.replace(path)
+        return data
+
+
+    def plan(self, jobs):
+        """Return dataframe with requests needed for jobs, with columns lat,
+        lon, start, end, units and cached.
+
+        :param jobs: list of tuples (lat, lon, start, end), with dates as
+            yyyymmdd or yyyy-mm-dd
+        """
+        ranges = {}
+        for lat, lon, start, end in jobs:
+            cell = (snap(lat, self.grid_size), snap(lon, self.grid_size))
+            ranges.setdefault(cell, []).append(to_dates(start, end))
+        rows = []
+        for (lat, lon), cell_ranges in ranges.items():
+            for start, end in merge_ranges(cell_ranges):
+                params = self.get_params(lat, lon, start, end)
+                rows.append({
+                    'lat': lat,
+                    'lon': lon,
+                    'start': start,
+                    'end': end,
+                    'units': count_months(start, end) * len(self.variables),
+                    'cached': bool(
+                        self.cache_dir
+                        and self.get_cache_path(params).exists()
+                    ),
+                })
+        return pd.DataFrame(
+            rows,
+            columns=['lat', 'lon', 'start', 'end', 'units', 'cached'],
+        )
+
+
+    def get_many(self, jobs):
+        """Return a dataframe with weather data for each job, in order of
+        jobs.
+
+        :param jobs: list of tuples (lat, lon, start, end), with dates as
+            yyyymmdd or yyyy-mm-dd
+        """
+        plan = self.plan(jobs)
+        units = plan.units[~plan.cached].sum()
+        if self.max_units is not None and units > self.max_units:
+            raise Exception(
+                f'Requests would use {units} units; maximum is '
+                f'{self.max_units}'
+            )
+        params = [
+            self.get_params(row.lat, row.lon, row.start, row.end)
+            for row in plan.itertuples()
+        ]
+        workers = max(1, min(self.workers, len(params)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            responses = list(executor.map(self.fetch, params))
+        frames = {}
+        for row, data in zip(plan.itertuples(), responses):
+            frames.setdefault((row.lat, row.lon), []).append(
+                process_oikolab(data)
+            )
+        results = []
+        for lat, lon, start, end in jobs:
+            cell = (snap(lat, self.grid_size), snap(lon, self.grid_size))
+            start, end = to_dates(start, end)
+            start = start.tz_localize('UTC')
+            end = end.tz_localize('UTC') + pd.Timedelta(days=1)
+            df = pd.concat([
+                df[(df.index >= start) & (df.index < end)]
+                for df in frames[cell]
+            ])
+            results.append(df[~df.index.duplicated()].sort_index())
+        return results
+
+
+def get_oikolab(lat, lon, start, end, api_key, variables, freq, **kwargs):
+    """Download hourly weather data from oikolab
+
+    :param kwargs: parameters passed on to OikolabClient, e.g. cache_dir
+    """
+    client = OikolabClient(
+        api_key, variables=variables, freq=freq, grid_size=None, **kwargs
+    )
+    return client.get_many([(lat, lon, start, end)])[0]
@@ -1,25 +1,98 @@
 """Plot rides"""
 
-from ipyleaflet import Map, Polyline
+import math
 import pandas as pd
 import numpy as np
+from bikeride.geo import douglas_peucker
 
 PALETTE = ['#1f78b4','#33a02c'] # from ColorBrewer
+# size (m) of a pixel at the equator at zoom level 0
+PIXEL_SIZE = 156543.03392
+# maximum number of points sent to the map
+MAX_POINTS = 20000
 
 
-def plot_rides(rides, how='direction', zoom=10, palette=None):
+def get_leaflet():
+    """Return ipyleaflet module, which is an optional dependency"""
+    try:
+        import ipyleaflet
+    except ImportError:
+        raise ImportError(
+            'Plotting requires ipyleaflet: pip install pybikeride[plot]'
+        ) from None
+    return ipyleaflet
+
+
+def pixel_size(zoom, lat):
+    """Return size (m) of a pixel at zoom level and latitude"""
+    return PIXEL_SIZE * math.cos(math.radians(lat)) / 2 ** zoom
+
+
+def get_runs(mask):
+    """Return list of (start, end) indices of runs of consecutive True
+    values in mask, with end exclusive."""
+    mask = np.asarray(mask, dtype=bool)
+    edges = np.diff(np.concatenate([[0], mask.view(np.int8), [0]]))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def simplify_lines(lines, tolerance=0, max_points=MAX_POINTS):
+    """Simplify lines with the Douglas-Peucker algorithm.
+
+    Returns a list with a list of [lat, lon] for each line.
+    :param lines: list of tuples (lats, lons)
+    :param tolerance: tolerance (m)
+    :param max_points: maximum total number of points; if needed, the
+        tolerance is increased so the simplified lines fit (end points of
+        lines are always kept)
+    """
+    significances = [
+        douglas_peucker(lats, lons, tolerance) for lats, lons in lines
+    ]
+    threshold = tolerance
+    if significances and max_points:
+        values = np.concatenate(significances)
+        # end points (with infinite significance) are always kept, so only
+        # the remaining budget goes to the other points
+        ends = np.isinf(values)
+        budget = max(max_points - np.count_nonzero(ends), 0)
+        values = values[~ends]
+        if np.count_nonzero(values > threshold) > budget:
+            if budget:
+                threshold = max(
+                    threshold, np.partition(values, -budget)[-budget]
+                )
+            else:
+                threshold = np.inf
+    simplified = []
+    for (lats, lons), significance in zip(lines, significances):
+        keep = (significance > threshold) | np.isinf(significance)
+        simplified.append(
+            np.column_stack([
+                np.asarray(lats)[keep], np.asarray(lons)[keep]
+            ]).tolist()
+        )
+    return simplified
+
+
+def plot_rides(rides, how='direction', zoom=10, palette=None,
+               max_points=MAX_POINTS, tolerance=None):
     """Plot list of rides on map
     :params rides: list of BikeRide objects
     :params how: if 'direction' plot line from start to median position; if
         'ride' plot entire ride
     :params zoom: initial zoom level
     :params palette: colours to use if plotting rides
+    :params max_points: maximum number of points of rides to plot
+    :params tolerance: tolerance (m) for simplifying rides; defaults to the
+        size of a pixel two zoom levels deeper than the initial zoom level
     """
+    leaflet = get_leaflet()
     if not palette:
         palette = PALETTE
     median_lat = np.median([ride.median_position[0] for ride in rides])
     median_lon = np.median([ride.median_position[1] for ride in rides])
-    m = Map(center=(median_lat, median_lon), zoom=zoom)
+    m = leaflet.Map(center=(median_lat, median_lon), zoom=zoom)
     if how == 'direction':
         summaries = pd.DataFrame([
             ride.summary for ride in rides
@@ -27,20 +100,31 @@ def plot_rides(rides, how='direction', zoom=10, palette=None):
         ])
         positions_start = zip(summaries.lat_start, summaries.lon_start)
         median_positions = [ride.median_position for ride in rides]
-        for pos_start, median_pos in zip(positions_start, median_positions):
-            poly_line = Polyline(
-                locations=(pos_start, median_pos),
-                color="red" ,
-                fill=False,
-                weight=1
-            )
-            m.add_layer(poly_line)
+        poly_line = leaflet.Polyline(
+            locations=[
+                [list(pos_start), list(median_pos)]
+                for pos_start, median_pos
+                in zip(positions_start, median_positions)
+            ],
+            color="red" ,
+            fill=False,
+            weight=1
+        )
+        m.add_layer(poly_line)
     elif how == 'ride':
-        for i, ride in enumerate(rides):
-            colour = palette[i % len(palette)]
-            locations = [(rec['lat'], rec['lon']) for rec in ride.records]
-            poly_line = Polyline(
-                locations=locations,
+        if tolerance is None:
+            tolerance = pixel_size(zoom + 2, median_lat)
+        lines = simplify_lines(
+            [(ride.track['lat'], ride.track['lon']) for ride in rides],
+            tolerance,
+            max_points,
+        )
+        # one layer per colour
+        for i, colour in enumerate(palette):
+            if not lines[i::len(palette)]:
+                continue
+            poly_line = leaflet.Polyline(
+                locations=lines[i::len(palette)],
                 color=colour,
                 fill=False,
                 weight=3
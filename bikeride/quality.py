@@ -0,0 +1,109 @@
+"""Flag pauses and outliers in segments"""
+
+import numpy as np
+import pandas as pd
+
+
+# bits of quality flags; a segment without problems has flag 0
+PAUSE = 1
+JUMP = 2
+SPEED = 4
+GRADIENT = 8
+FLAGS = {'pause': PAUSE, 'jump': JUMP, 'speed': SPEED, 'gradient': GRADIENT}
+# default limits used to flag segments
+LIMITS = {
+    # speed (m/s) below which a segment counts as stopped
+    'stop_speed': 0.5,
+    # minimum duration (s) of consecutive stopped segments to count as pause
+    'min_pause': 60,
+    # segments lasting longer (s) count as pause (e.g. recording paused)
+    'max_gap': 60,
+    # maximum plausible speed (m/s)
+    'max_speed': 25,
+    # gps jump: a segment at least min_jump (m) long that is jump_factor
+    # times faster (or, without timestamps, longer) than the rolling median
+    'jump_factor': 5,
+    'min_jump': 50,
+    # number of segments in rolling median
+    'window': 9,
+    # maximum plausible gradient (%), for segments with an ascent or
+    # descent of at least min_ascent (m)
+    'max_gradient': 25,
+    'min_ascent': 2,
+}
+
+
+def get_run_mask(mask, weights, minimum):
+    """Return mask of runs of consecutive True values in mask for which the
+    sum of weights is at least minimum."""
+    mask = np.asarray(mask, dtype=bool)
+    edges = np.diff(np.concatenate([[0], mask.view(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    cumulative = np.concatenate([[0], np.cumsum(np.nan_to_num(weights))])
+    long = cumulative[ends] - cumulative[starts] >= minimum
+    changes = np.zeros(len(mask) + 1, dtype=np.int64)
+    changes[starts[long]] += 1
+    changes[ends[long]] -= 1
+    return np.cumsum(changes[:-1]) > 0
+
+
+def flag_segments(segments, limits=None):
+    """Return array with quality flags (see FLAGS) for each segment.
+
+    :param segments: dataframe of segments
+    :param limits: dict with limits to use instead of those in LIMITS
+    """
+    limits = {**LIMITS, **(limits or {})}
+    n = len(segments)
+    flags = np.zeros(n, dtype=np.int8)
+    if not n:
+        return flags
+    length = segments['length_calculated'].to_numpy(float)
+    window = limits['window']
+    if 'duration' in segments:
+        duration = segments['duration'].to_numpy(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = np.where(duration > 0, length / duration, np.nan)
+        stopped = (speed < limits['stop_speed']) | (duration > limits['max_gap'])
+        flags[get_run_mask(stopped, duration, limits['min_pause'])] |= PAUSE
+        flags[duration > limits['max_gap']] |= PAUSE
+        flags[speed > limits['max_speed']] |= SPEED
+        typical = pd.Series(speed).rolling(
+            window, center=True, min_periods=1
+        ).median().to_numpy()
+        moving = speed
+    else:
+        typical = pd.Series(length).rolling(
+            window, center=True, min_periods=1
+        ).median().to_numpy()
+        moving = length
+    with np.errstate(invalid='ignore'):
+        jump = (
+            (moving > limits['jump_factor'] * typical)
+            & (length >= limits['min_jump'])
+        )
+    flags[jump] |= JUMP
+    if 'gradient' in segments:
+        gradient = segments['gradient'].to_numpy(float)
+        ascent = segments['ascent'].to_numpy(float)
+        with np.errstate(invalid='ignore'):
+            steep = (
+                (np.abs(gradient) > limits['max_gradient'])
+                & (np.abs(ascent) >= limits['min_ascent'])
+            )
+        flags[steep] |= GRADIENT
+    return flags
+
+
+def describe_flags(flags):
+    """Return list of names of flags (e.g. 'pause, jump') for array of
+    flags; segments without problems get an empty string."""
+    flags = np.asarray(flags)
+    names = np.full(len(flags), '', dtype=object)
+    for name, bit in FLAGS.items():
+        has_flag = (flags & bit) > 0
+        names[has_flag] = np.where(
+            names[has_flag] == '', name, names[has_flag] + ', ' + name
+        )
+    return list(names)
@@ -0,0 +1,130 @@
+"""Create segments from pairs of consecutive records"""
+
+import numpy as np
+import pandas as pd
+from bikeride.geo import bearing, get_distance_function
+
+
+def as_float(values):
+    """Convert values to float array, with missing values as nan"""
+    return pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(float)
+
+
+def build_segments(columns, distance_model='ellipsoidal'):
+    """Create dataframe of segments from columns of records.
+
+    :param columns: Track, dataframe or dict of arrays containing at least
+        lat and lon; timestamp, distance, temperature, speed and altitude are used
+        if present
+    :param distance_model: 'ellipsoidal' or 'haversine' (see bikeride.geo)
+    """
+    lat = as_float(columns['lat'])
+    lon = as_float(columns['lon'])
+    n = max(len(lat) - 1, 0)
+    lat_start, lat_end = lat[:-1], lat[1:]
+    lon_start, lon_end = lon[:-1], lon[1:]
+    distance = get_distance_function(distance_model)
+    segments = {
+        'id': np.arange(n),
+        'lat_start': lat_start,
+        'lon_start': lon_start,
+        'lat_end': lat_end,
+        'lon_end': lon_end,
+        'length_calculated': distance(lat_start, lon_start, lat_end, lon_end),
+        'heading': bearing(lat_start, lon_start, lat_end, lon_end),
+    }
+    if 'timestamp' in columns:
+        timestamp = pd.Series(pd.to_datetime(columns['timestamp'], utc=True))
+        segments['timestamp_start'] = timestamp.iloc[:-1].array
+        segments['timestamp_end'] = timestamp.iloc[1:].array
+        duration = timestamp.diff().dt.total_seconds().iloc[1:]
+        segments['duration'] = duration.to_numpy()
+    if 'distance' in columns:
+        distance_recorded = as_float(columns['distance'])
+        segments['distance_recorded_start'] = distance_recorded[:-1]
+        segments['distance_recorded_end'] = distance_recorded[1:]
+        segments['length_recorded'] = np.diff(distance_recorded)
+    if 'temperature' in columns:
+        segments['temp_recorded_start'] = as_float(columns['temperature'])[:-1]
+    if 'speed' in columns:
+        speed = as_float(columns['speed'])
+        segments['speed_recorded_start'] = speed[:-1]
+        segments['speed_recorded_end'] = speed[1:]
+    if 'altitude' in columns:
+        altitude = as_float(columns['altitude'])
+        segments['altitude_start'] = altitude[:-1]
+        segments['altitude_end'] = altitude[1:]
+        ascent = np.diff(altitude)
+        segments['ascent'] = ascent
+        length = segments['length_calculated']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            segments['gradient'] = np.where(
+                length > 0, 100 * ascent / length, np.nan
+            )
+    return pd.DataFrame(segments)
+
+
+def get_bins(columns, bin_size, by='distance', distance_model='ellipsoidal'):
+    """Divide records into bins of a fixed distance or duration.
+
+    Returns an array with indices of the records at the boundaries of bins,
+    i.e. the first record, the records where the cumulative distance or time
+    first reaches a multiple of bin_size, and the last record, and an array
+    with the length (m) of the track within each bin.
+    :param columns: Track, dataframe or dict of arrays containing at least
+        lat and lon, and timestamp if by is 'time'
+    :param bin_size: size of bins (m if by is 'distance'; s if by is 'time')
+    :param by: 'distance' or 'time'
+    :param distance_model: 'ellipsoidal' or 'haversine' (see bikeride.geo)
+    """
+    lat = as_float(columns['lat'])
+    lon = as_float(columns['lon'])
+    n = len(lat)
+    if n < 2:
+        return np.arange(n), np.zeros(0)
+    distance = get_distance_function(distance_model)
+    lengths = distance(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    cumulative_length = np.concatenate([[0], np.cumsum(np.nan_to_num(lengths))])
+    if by == 'distance':
+        cumulative = cumulative_length
+    elif by == 'time':
+        if 'timestamp' not in columns:
+            raise Exception('Resampling by time requires timestamps')
+        timestamp = pd.Series(pd.to_datetime(columns['timestamp'], utc=True))
+        seconds = (timestamp - timestamp.iloc[0]).dt.total_seconds()
+        # missing timestamps are treated as the previous timestamp
+        cumulative = np.maximum.accumulate(seconds.ffill().fillna(0).to_numpy())
+    else:
+        raise Exception(f'Cannot resample by {by}')
+    edges = np.arange(1, cumulative[-1] // bin_size + 1) * bin_size
+    indices = np.unique(np.concatenate([
+        [0], np.searchsorted(cumulative, edges), [n - 1]
+    ]))
+    return indices, np.diff(cumulative_length[indices])
+
+
+def build_binned_segments(columns, indices, lengths,
+                          distance_model='ellipsoidal'):
+    """Create dataframe with a segment for each bin of records (see
+    get_bins).
+
+    Segments run from the first to the last record of a bin, so heading and
+    gradient are calculated over the bin; length_calculated is the length of
+    the track within the bin, and records the number of record pairs in it.
+    :param columns: Track, dataframe or dict of arrays
+    :param indices: indices of records at the boundaries of bins
+    :param lengths: length (m) of the track within each bin
+    :param distance_model: 'ellipsoidal' or 'haversine' (see bikeride.geo)
+    """
+    segments = build_segments(
+        {name: np.asarray(columns[name])[indices] for name in columns},
+        distance_model,
+    )
+    segments['length_calculated'] = lengths
+    segments['records'] = np.diff(indices)
+    if 'ascent' in segments:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            segments['gradient'] = np.where(
+                lengths > 0, 100 * segments['ascent'] / lengths, np.nan
+            )
+    return segments
@@ -0,0 +1,343 @@
+"""Store summaries and segments of a library of rides in a SQLite database"""
+
+from pathlib import Path
+import sqlite3
+import pandas as pd
+from bikeride.bikeride import BikeRide
+from bikeride.cache import file_digest
+from bikeride.collection import get_error, map_paths
+
+
+# timestamps are stored as text in UTC, so they can be compared as strings
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rides (hash TEXT PRIMARY KEY, path TEXT);
+CREATE TABLE IF NOT EXISTS segments (ride_hash TEXT);
+CREATE TABLE IF NOT EXISTS columns (
+    tbl TEXT, name TEXT, kind TEXT, PRIMARY KEY (tbl, name)
+);
+CREATE INDEX IF NOT EXISTS segments_ride ON segments (ride_hash);
+"""
+# columns of segments that are indexed when they are added
+SEGMENT_INDEXES = ['timestamp_start', 'lat_start']
+
+
+def column_kind(values):
+    """Return kind of column (datetime, integer, real or text)"""
+    if isinstance(values.dtype, pd.DatetimeTZDtype) or (
+        pd.api.types.is_datetime64_dtype(values)
+    ):
+        return 'datetime'
+    if pd.api.types.is_bool_dtype(values) or (
+        pd.api.types.is_integer_dtype(values)
+    ):
+        return 'integer'
+    if pd.api.types.is_numeric_dtype(values):
+        return 'real'
+    return 'text'
+
+
+def format_time(value):
+    """Format timestamp as stored in database (naive timestamps are assumed
+    to be UTC)"""
+    value = pd.Timestamp(value)
+    if value.tzinfo is None:
+        value = value.tz_localize('UTC')
+    return value.tz_convert('UTC').strftime(TIME_FORMAT)
+
+
+def to_rows(df, kinds):
+    """Return list of tuples with values of dataframe as stored in
+    database"""
+    df = df.copy()
+    for name, kind in kinds.items():
+        if kind == 'datetime':
+            values = pd.to_datetime(df[name], utc=True)
+            df[name] = values.dt.strftime(TIME_FORMAT).where(values.notna())
+        elif kind == 'text':
+            df[name] = df[name].where(df[name].isna(), df[name].astype(str))
+    df = df.astype(object).where(df.notna(), None)
+    return list(df.itertuples(index=False, name=None))
+
+
+def process_for_store(path, **kwargs):
+    """Create BikeRide from gps file and return dict with its path, summary
+    and segments (with quality flags), or the error if it can't be
+    processed.
+
+    Runs in worker processes.
+    """
+    try:
+        ride = BikeRide(path, **kwargs)
+        summary = ride.summary
+        segments = ride.segment_table.assign(quality=ride.quality)
+    except Exception as e:
+        return get_error(path, e)
+    return {'path': str(path), 'summary': summary, 'segments': segments}
+
+
+class RideStore():
+    """Summaries and segments (incl. weather data) of many rides in a SQLite
+    database, with a rides table keyed by the hash of the gps file and a
+    segments table.
+
+    Adding files is idempotent: files whose contents are already in the
+    store are skipped. Columns are added to the tables when rides with new
+    summary stats or segment variables are added. Queries filter rows in the
+    database, so only the rows needed are loaded.
+    """
+    def __init__(self, path):
+        """
+        :param path: path to database file
+        """
+        self.path = Path(path)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(SCHEMA)
+        self.failures = {}
+
+
+    def close(self):
+        """Close database connection"""
+        self.connection.close()
+
+
+    def get_kinds(self, table):
+        """Return dict with kind of each column of table"""
+        return dict(self.connection.execute(
+            'SELECT name, kind FROM columns WHERE tbl = ?', (table,)
+        ).fetchall())
+
+
+    def add_columns(self, table, df):
+        """Add columns of dataframe that are missing in table"""
+        existing = {
+            row[1] for row in
+            self.connection.execute(f'PRAGMA table_info({table})')
+        }
+        for name in df.columns:
+            if name in existing:
+                continue
+            kind = column_kind(df[name])
+            sql_type = {'integer': 'INTEGER', 'real': 'REAL'}.get(kind, 'TEXT')
+            self.connection.execute(
+                f'ALTER TABLE {table} ADD COLUMN "{name}" {sql_type}'
+            )
+            self.connection.execute(
+                'INSERT INTO columns VALUES (?, ?, ?)', (table, name, kind)
+            )
+            if table == 'segments' and name in SEGMENT_INDEXES:
+                self.connection.execute(
+                    f'CREATE INDEX segments_{name} ON segments ("{name}")'
+                )
+
+
+    def insert(self, table, df):
+        """Insert rows of dataframe into table"""
+        self.add_columns(table, df)
+        kinds = self.get_kinds(table)
+        names = ', '.join(f'"{name}"' for name in df.columns)
+        placeholders = ', '.join('?' for _ in df.columns)
+        self.connection.executemany(
+            f'INSERT INTO {table} ({names}) VALUES ({placeholders})',
+            to_rows(df, {name: kinds.get(name) for name in df.columns}),
+        )
+
+
+    def contains(self, key):
+        """Return whether ride with hash key is in store"""
+        return self.connection.execute(
+            'SELECT 1 FROM rides WHERE hash = ?', (key,)
+        ).fetchone() is not None
+
+
+    def add(self, paths, workers=None, **kwargs):
+        """Process gps files that are not in the store yet and add their
+        summaries and segments. Returns number of rides added.
+
+        :param paths: paths to gps files
+        :param workers: number of worker processes (defaults to number of
+            cpus); if 1, files are processed in the current process
+        :param kwargs: parameters passed on to BikeRide, e.g. path_weather;
+            a WeatherStore is fetched in this process first (see map_paths)
+        """
+        new = {}
+        for path in paths:
+            key = file_digest(path).hexdigest()
+            if key not in new and not self.contains(key):
+                new[key] = str(path)
+        results = map_paths(
+            process_for_store, new.values(), workers, **kwargs
+        )
+        added = 0
+        try:
+            # each ride is added in a transaction, so an interrupted run
+            # doesn't leave partial rides
+            for key, result in zip(new, results):
+                if 'error' in result:
+                    self.failures[result['path']] = result['error']
+                    continue
+                with self.connection:
+                    self.insert('segments', result['segments'].assign(
+                        ride_hash=key
+                    ))
+                    self.insert('rides', pd.DataFrame([{
+                        'hash': key,
+                        'path': result['path'],
+                        **result['summary'],
+                    }]))
+                added += 1
+        finally:
+            results.close()
+        return added
+
+
+    def get_filters(self, table, start=None, end=None, sport=None,
+                    bbox=None, filters=None):
+        """Return SQL condition and parameters for filters"""
+        existing = self.get_kinds(table)
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append('timestamp_start >= ?')
+            params.append(format_time(start))
+        if end is not None:
+            conditions.append('timestamp_start < ?')
+            params.append(format_time(end))
+        if sport is not None:
+            if 'sport' not in self.get_kinds('rides'):
+                # no ride has a sport
+                conditions.append('0')
+            elif table == 'rides':
+                conditions.append('sport = ?')
+                params.append(sport)
+            else:
+                conditions.append(
+                    'ride_hash IN (SELECT hash FROM rides WHERE sport = ?)'
+                )
+                params.append(sport)
+        if bbox is not None:
+            lat_min, lon_min, lat_max, lon_max = bbox
+            conditions.append(
+                'lat_start BETWEEN ? AND ? AND lon_start BETWEEN ? AND ?'
+            )
+            params.extend([lat_min, lat_max, lon_min, lon_max])
+        for name, value in (filters or {}).items():
+            if name not in existing and name not in ['hash', 'ride_hash']:
+                raise Exception(f'Column {name} not in {table}')
+            if isinstance(value, tuple):
+                conditions.append(f'"{name}" BETWEEN ? AND ?')
+                params.extend(value)
+            elif isinstance(value, list):
+                placeholders = ', '.join('?' for _ in value)
+                conditions.append(f'"{name}" IN ({placeholders})')
+                params.extend(value)
+            else:
+                conditions.append(f'"{name}" = ?')
+                params.append(value)
+        return ' AND '.join(conditions) or '1', params
+
+
+    def read(self, table, sql, params, chunksize=None):
+        """Run query and return dataframe (or iterator of dataframes if
+        chunksize is set), with timestamps converted"""
+        datetimes = [
+            name for name, kind in self.get_kinds(table).items()
+            if kind == 'datetime'
+        ]
+
+        def convert(df):
+            for name in datetimes:
+                if name in df:
+                    df[name] = pd.to_datetime(
+                        df[name], format='ISO8601', utc=True
+                    )
+            return df
+
+        result = pd.read_sql_query(
+            sql, self.connection, params=params, chunksize=chunksize
+        )
+        if chunksize:
+            return (convert(df) for df in result)
+        return convert(result)
+
+
+    def select(self, table, columns):
+        """Return SQL for selected columns"""
+        if not columns:
+            return '*'
+        existing = set(self.get_kinds(table)) | {'hash', 'path', 'ride_hash'}
+        for name in columns:
+            if name not in existing:
+                raise Exception(f'Column {name} not in {table}')
+        return ', '.join(f'"{name}"' for name in columns)
+
+
+    def rides(self, columns=None, **kwargs):
+        """Return dataframe with summaries of rides.
+
+        :param columns: columns to return (defaults to all)
+        :param kwargs: filters, see segments
+        """
+        condition, params = self.get_filters('rides', **kwargs)
+        return self.read(
+            'rides',
+            f'SELECT {self.select("rides", columns)} FROM rides '
+            f'WHERE {condition}',
+            params,
+        )
+
+
+    def segments(self, columns=None, chunksize=None, **kwargs):
+        """Return dataframe with segments, or an iterator of dataframes with
+        chunksize segments if chunksize is set.
+
+        :param columns: columns to return (defaults to all)
+        :param chunksize: number of segments per dataframe
+        :param start: only segments starting at or after this time (UTC)
+        :param end: only segments starting before this time (UTC)
+        :param sport: only segments of rides of this sport
+        :param bbox: only segments starting in bounding box (lat_min,
+            lon_min, lat_max, lon_max)
+        :param filters: dict with column names and values; a tuple selects a
+            range (min, max) and a list a set of values, e.g.
+            {'twa_rounded_abs': 0, 'quality': 0, 'gradient': (-2, 2)}
+        """
+        condition, params = self.get_filters('segments', **kwargs)
+        return self.read(
+            'segments',
+            f'SELECT {self.select("segments", columns)} FROM segments '
+            f'WHERE {condition}',
+            params,
+            chunksize,
+        )
+
+
+    def summarize_by(self, by, **kwargs):
+        """Return dataframe with number of segments, total length, duration
+        and ascent and average speed for groups of segments, calculated in
+        the database.
+
+        :param by: column name or list of column names, e.g.
+            'twa_rounded_abs'
+        :param kwargs: filters, see segments
+        """
+        if isinstance(by, str):
+            by = [by]
+        groups = self.select('segments', by)
+        condition, params = self.get_filters('segments', **kwargs)
+        kinds = self.get_kinds('segments')
+        totals = [
+            f'SUM("{name}") AS "{name}"'
+            for name in ['length_calculated', 'duration', 'ascent']
+            if name in kinds
+        ]
+        df = self.read(
+            'segments',
+            f'SELECT {groups}, COUNT(*) AS segments, {", ".join(totals)} '
+            f'FROM segments WHERE {condition} GROUP BY {groups} '
+            f'ORDER BY {groups}',
+            params,
+        )
+        if 'duration' in df:
+            df['speed'] = df.length_calculated / df.duration
+        return df.set_index(by)
@@ -0,0 +1,230 @@
+"""Calculate summary stats from segments"""
+
+import math
+import numpy as np
+import pandas as pd
+from bikeride.geo import bearing
+
+
+# variables for which the average weighted by duration is calculated
+WEIGHTED_VARS = ['temperature', 'wind_speed', 'wind_direction']
+
+
+class RunningSummary():
+    """Summary stats that are updated as segments are added, in constant time
+    per segment.
+    """
+    def __init__(self):
+        self.n_segments = 0
+        self.first = None
+        self.last = None
+        self.sums = {}
+
+
+    def add(self, name, value):
+        """Add value to running sum"""
+        if not math.isnan(value):
+            self.sums[name] = self.sums.get(name, 0) + value
+
+
+    def update(self, segments):
+        """Add dataframe of new segments to summary stats"""
+        if not len(segments):
+            return
+        if self.first is None:
+            self.first = segments.iloc[0]
+        self.last = segments.iloc[-1]
+        self.n_segments += len(segments)
+        self.add('length_calculated', segments.length_calculated.sum())
+        if 'duration' in segments:
+            self.add('duration', segments.duration.sum())
+            for var in WEIGHTED_VARS:
+                if var in segments:
+                    weighted = (segments[var] * segments.duration).sum()
+                    self.add(f'{var}_x_duration', weighted)
+        if 'length_recorded' in segments:
+            self.add('length_recorded', segments.length_recorded.sum())
+        if 'ascent' in segments:
+            ascent = segments.ascent
+            self.add('total_ascent', ascent[ascent > 0].sum())
+            self.add('total_descent', ascent[ascent < 0].sum())
+
+
+    @property
+    def summary(self):
+        """Return dict with summary stats"""
+        if not self.n_segments:
+            return {}
+        sums = self.sums
+        summary = {
+            'length_calculated': sums.get('length_calculated', 0),
+            'lat_start': self.first['lat_start'],
+            'lon_start': self.first['lon_start'],
+        }
+        duration = sums.get('duration')
+        if duration is not None:
+            summary['duration'] = duration
+            summary['timestamp_start'] = self.first['timestamp_start']
+            summary['timestamp_end'] = self.last['timestamp_end']
+        if duration:
+            summary['speed_from_length_calculated'] = (
+                summary['length_calculated'] / duration
+            )
+        if 'length_recorded' in sums:
+            summary['length_recorded'] = sums['length_recorded']
+            if duration:
+                summary['speed_from_length_recorded'] = (
+                    sums['length_recorded'] / duration
+                )
+        if duration:
+            for var in WEIGHTED_VARS:
+                if f'{var}_x_duration' in sums:
+                    summary[var] = sums[f'{var}_x_duration'] / duration
+        for var in ['total_ascent', 'total_descent']:
+            if var in sums:
+                summary[var] = sums[var]
+        return summary
+
+
+def get_values_to_sum(segments, additional_vars=None):
+    """Return dataframe with the values per segment that are summed to
+    calculate summary stats for groups of segments."""
+    values = {'length_calculated': segments.length_calculated}
+    if 'duration' in segments:
+        duration = segments.duration
+        values['duration'] = duration
+        weighted_vars = WEIGHTED_VARS + [
+            var for var in additional_vars or []
+            if var in segments and var not in WEIGHTED_VARS
+            and pd.api.types.is_numeric_dtype(segments[var])
+        ]
+        for var in weighted_vars:
+            if var in segments:
+                values[f'{var}_x_duration'] = segments[var] * duration
+    if 'length_recorded' in segments:
+        values['length_recorded'] = segments.length_recorded
+    if 'ascent' in segments:
+        ascent = segments.ascent
+        values['total_ascent'] = ascent.where(ascent > 0, 0)
+        values['total_descent'] = ascent.where(ascent < 0, 0)
+    return pd.DataFrame(values).fillna(0)
+
+
+def finish_summaries(sums, first, last, median_position=None):
+    """Calculate summary stats for groups of segments.
+
+    :param sums: dataframe with sums of get_values_to_sum per group
+    :param first: dataframe with first segment of each group
+    :param last: dataframe with last segment of each group
+    :param median_position: median position of ride, to calculate direction
+    """
+    summaries = pd.DataFrame(index=sums.index)
+    summaries['length_calculated'] = sums.length_calculated
+    duration = None
+    if 'duration' in sums:
+        duration = sums.duration.where(sums.duration != 0)
+        summaries['duration'] = sums.duration
+        summaries['speed_from_length_calculated'] = (
+            sums.length_calculated / duration
+        )
+    summaries['lat_start'] = first.lat_start
+    summaries['lon_start'] = first.lon_start
+    if median_position is not None:
+        summaries['direction'] = bearing(
+            first.lat_start, first.lon_start, *median_position
+        )
+    if 'timestamp_start' in first:
+        summaries['timestamp_start'] = first.timestamp_start
+        summaries['timestamp_end'] = last.timestamp_end
+    if 'length_recorded' in sums:
+        summaries['length_recorded'] = sums.length_recorded
+        if duration is not None:
+            summaries['speed_from_length_recorded'] = (
+                sums.length_recorded / duration
+            )
+    for col in sums.columns:
+        if col.endswith('_x_duration'):
+            summaries[col[:-len('_x_duration')]] = sums[col] / duration
+    for col in ['total_ascent', 'total_descent']:
+        if col in sums:
+            summaries[col] = sums[col]
+    return summaries
+
+
+def summarize_groups(segments, keys, median_position=None,
+                     additional_vars=None):
+    """Return dataframe with summary stats for each group of segments, using
+    grouped reductions.
+
+    :param segments: dataframe of segments
+    :param keys: column name(s) or array(s) with group key per segment, as
+        accepted by DataFrame.groupby
+    :param median_position: median position of ride, to calculate direction
+    :param additional_vars: additional variables to include; numeric
+        variables are weighted by duration, for others the first value is
+        used
+    """
+    values = get_values_to_sum(segments, additional_vars)
+    edge_cols = [
+        col for col in [
+            'lat_start', 'lon_start', 'timestamp_start', 'timestamp_end'
+        ]
+        if col in segments
+    ]
+    other_vars = [
+        var for var in additional_vars or []
+        if var in segments and f'{var}_x_duration' not in values
+    ]
+    if isinstance(keys, str):
+        keys = segments[keys]
+    elif isinstance(keys, list):
+        keys = [segments[k] if isinstance(k, str) else k for k in keys]
+    groups = pd.concat(
+        [values, segments[edge_cols + other_vars]], axis=1
+    ).groupby(keys, observed=True, sort=True)
+    sums = groups[list(values.columns)].sum()
+    first = groups[edge_cols + other_vars].first()
+    last = groups[edge_cols].last()
+    summaries = finish_summaries(sums, first, last, median_position)
+    for var in other_vars:
+        summaries[var] = first[var]
+    summaries.insert(0, 'n_segments', groups.size())
+    return summaries
+
+
+def summarize_masks(segments, masks, names=None, median_position=None,
+                    additional_vars=None):
+    """Return dataframe with summary stats for each mask in a 2-D boolean
+    matrix (number of masks x number of segments). Masks may overlap; all
+    sums are calculated in one matrix product.
+
+    :param segments: dataframe of segments
+    :param masks: 2-D array of booleans
+    :param names: names of masks, used as index
+    :param median_position: median position of ride, to calculate direction
+    :param additional_vars: additional variables to include (see
+        summarize_groups)
+    """
+    masks = np.atleast_2d(np.asarray(masks, dtype=bool))
+    if not len(segments) or not len(masks):
+        return pd.DataFrame()
+    if masks.shape[1] != len(segments):
+        raise Exception('Masks should have one column per segment')
+    values = get_values_to_sum(segments, additional_vars)
+    index = pd.Index(names if names is not None else range(len(masks)))
+    sums = pd.DataFrame(
+        masks.astype(float) @ values.to_numpy(float),
+        index=index,
+        columns=values.columns,
+    )
+    has_segments = masks.any(axis=1)
+    idx_first = np.argmax(masks, axis=1)
+    idx_last = masks.shape[1] - 1 - np.argmax(masks[:, ::-1], axis=1)
+    first = segments.iloc[idx_first].set_index(index)
+    last = segments.iloc[idx_last].set_index(index)
+    summaries = finish_summaries(sums, first, last, median_position)
+    for var in additional_vars or []:
+        if var in segments and f'{var}_x_duration' not in values:
+            summaries[var] = first[var]
+    summaries.insert(0, 'n_segments', masks.sum(axis=1))
+    return summaries[has_segments]
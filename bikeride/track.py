@@ -0,0 +1,172 @@
+"""Store records of a ride as typed numpy arrays"""
+
+import numpy as np
+import pandas as pd
+
+
+# columns that are always stored as float64, because float32 would cause
+# errors of up to about a metre in positions
+POSITION_COLUMNS = ['lat', 'lon']
+
+
+def missing_value(dtype):
+    """Return value for missing data in array of dtype"""
+    if dtype.kind == 'M':
+        return np.datetime64('NaT')
+    return np.nan
+
+
+def to_datetime64(values):
+    """Convert timestamps to datetime64[ns] array (UTC)"""
+    values = pd.DatetimeIndex(pd.to_datetime(values, utc=True))
+    return values.tz_convert(None).to_numpy('datetime64[ns]')
+
+
+class Track():
+    """Records of a ride as a set of equally long numpy arrays (columns),
+    e.g. lat, lon, timestamp, altitude, distance, speed, cadence and
+    temperature. Missing values are stored as nan or NaT.
+
+    Indexing with a column name returns the array; indexing with a slice,
+    boolean mask or array of indices returns a new Track (for slices, the
+    arrays are views on the original arrays).
+    """
+    __slots__ = ('data', 'buffers')
+
+    def __init__(self, columns, float32=False):
+        """
+        :param columns: dict of arrays, or dataframe, containing at least lat
+            and lon
+        :param float32: store numeric columns other than lat and lon as
+            float32 to save memory
+        """
+        dtype = np.float32 if float32 else np.float64
+        self.buffers = None
+        self.data = {}
+        for name in columns:
+            values = columns[name]
+            if name == 'timestamp':
+                values = to_datetime64(values)
+            elif name in POSITION_COLUMNS:
+                values = np.asarray(values, dtype=np.float64)
+            else:
+                values = pd.to_numeric(pd.Series(values), errors='coerce')
+                values = values.to_numpy(dtype, na_value=np.nan)
+            self.data[name] = values
+        for name in POSITION_COLUMNS:
+            self.data.setdefault(name, np.empty(0))
+
+
+    @classmethod
+    def from_arrays(cls, data):
+        """Create Track from dict of arrays without converting them"""
+        track = cls.__new__(cls)
+        track.data = data
+        track.buffers = None
+        return track
+
+
+    def __len__(self):
+        return len(self.data['lat'])
+
+
+    def __contains__(self, name):
+        return name in self.data
+
+
+    def __iter__(self):
+        return iter(self.data)
+
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        if isinstance(key, (int, np.integer)):
+            return {name: values[key] for name, values in self.data.items()}
+        return Track.from_arrays({
+            name: values[key] for name, values in self.data.items()
+        })
+
+
+    def __repr__(self):
+        return f'Track({len(self)} records; columns: {", ".join(self.data)})'
+
+
+    @property
+    def columns(self):
+        """Names of columns"""
+        return list(self.data)
+
+
+    @property
+    def nbytes(self):
+        """Memory used by arrays (bytes)"""
+        return sum(values.nbytes for values in self.data.values())
+
+
+    def extend(self, other):
+        """Append records of other Track in place.
+
+        Arrays are stored in over-allocated buffers, so that appending takes
+        amortized constant time per record. Columns missing in either track
+        are filled with nan or NaT.
+        """
+        n = len(self)
+        k = len(other)
+        names = list(self.data) + [
+            name for name in other.data if name not in self.data
+        ]
+        if (
+            self.buffers is None
+            or n + k > len(self.buffers['lat'])
+            or set(names) != set(self.buffers)
+        ):
+            capacity = max(2 * (n + k), 1024)
+            buffers = {}
+            for name in names:
+                if name in self.data:
+                    values = self.data[name]
+                    buffer = np.empty(capacity, values.dtype)
+                    buffer[:n] = values
+                else:
+                    dtype = other.data[name].dtype
+                    buffer = np.empty(capacity, dtype)
+                    buffer[:n] = missing_value(dtype)
+                buffers[name] = buffer
+            self.buffers = buffers
+        for name, buffer in self.buffers.items():
+            if name in other.data:
+                buffer[n: n + k] = other.data[name]
+            else:
+                buffer[n: n + k] = missing_value(buffer.dtype)
+            self.data[name] = buffer[:n + k]
+
+
+    def to_pandas(self):
+        """Return dataframe that shares memory with the arrays where possible;
+        timestamps are localized to UTC."""
+        df = pd.DataFrame(self.data, copy=False)
+        if 'timestamp' in df:
+            df['timestamp'] = df['timestamp'].dt.tz_localize('UTC')
+        return df
+
+
+    def to_arrow(self):
+        """Return pyarrow table (requires pyarrow); numeric arrays are not
+        copied."""
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError('Track.to_arrow requires pyarrow') from None
+        arrays = {}
+        for name, values in self.data.items():
+            if name == 'timestamp':
+                arrays[name] = pa.array(values, type=pa.timestamp('ns', 'UTC'))
+            else:
+                arrays[name] = pa.array(values)
+        return pa.table(arrays)
+
+
+    def to_records(self):
+        """Return list of dicts, one per record (for compatibility)"""
+        return self.to_pandas().to_dict('records')
@@ -1,10 +1,22 @@
-"""Download hourly weather data"""
+"""Download hourly weather data and join weather data to ride segments"""
 
-from bikeride.knmi import get_knmi
-from bikeride.oikolab import get_oikolab
+import copy
+import math
+import numpy as np
+import pandas as pd
+from bikeride.knmi import get_knmi, nearest_stations, split_days
+from bikeride.oikolab import get_oikolab, snap
 
 
-def get_weather(source, lat, lon, start, end=None, api_key=None, variables=None, freq='H'):
+DT_VARS = ['date', 'hour', 'minute']
+RESOLUTIONS = {
+    'minute': pd.Timedelta(minutes=1),
+    'hour': pd.Timedelta(hours=1),
+    'date': pd.Timedelta(days=1),
+}
+
+
+def get_weather(source, lat, lon, start, end=None, api_key=None, variables=None, freq='H', **kwargs):
     """Download hourly weather data for location
     :param source: source to get data from
     :param lat: latitude for location
@@ -14,11 +26,283 @@ def get_weather(source, lat, lon, start, end=None, api_key=None, variables=None,
     :param api_key: api key for weather data provider (if applicable)
     :param variables: variables to be included
     :param freq: 'H' for hourly data; 'D' for daily
+    :param kwargs: parameters passed on to the client of the source, e.g.
+        cache_dir and url
     """
     if not end:
         end = start
     if source.lower() == 'knmi':
-        return get_knmi(lat, lon, start, end)
+        return get_knmi(lat, lon, start, end, **kwargs)
     if source.lower() == 'oikolab':
-        return get_oikolab(lat, lon, start, end, api_key, variables, freq)
+        return get_oikolab(
+            lat, lon, start, end, api_key, variables, freq, **kwargs
+        )
     return None
+
+
+def get_resolution(weather):
+    """Return time step of weather data, based on its date and time columns"""
+    for var in ['minute', 'hour', 'date']:
+        if var in weather.columns:
+            return RESOLUTIONS[var]
+    raise Exception('Weather data should contain a date column')
+
+
+def index_weather(weather):
+    """Return weather data sorted and indexed by UTC timestamp.
+
+    The timestamp is created from the date (yyyymmdd) and, if present, hour
+    and minute columns, unless the data already have a UTC index (e.g. KNMI
+    data from get_weather).
+    """
+    get_resolution(weather)
+    if isinstance(weather.index, pd.DatetimeIndex) and (
+        weather.index.tz is not None
+    ):
+        weather = weather.tz_convert('UTC').rename_axis('timestamp')
+        return weather.sort_index(kind='stable')
+    dates = pd.to_numeric(weather['date']).astype('int64').astype(str)
+    timestamp = pd.to_datetime(dates.to_numpy(), format='%Y%m%d', utc=True)
+    if 'hour' in weather.columns:
+        hours = pd.to_numeric(weather['hour']).to_numpy()
+        timestamp += pd.to_timedelta(hours, unit='h')
+    if 'minute' in weather.columns:
+        minutes = pd.to_numeric(weather['minute']).to_numpy()
+        timestamp += pd.to_timedelta(minutes, unit='min')
+    weather = weather.set_index(pd.DatetimeIndex(timestamp, name='timestamp'))
+    return weather.sort_index(kind='stable')
+
+
+def join_weather(segments, weather):
+    """Add weather data to segments dataframe, matching on timestamp_start.
+
+    Minute and daily data are matched to the minute or day the segment
+    starts in. Numeric hourly data are interpolated between the hour the
+    segment starts in and the next hour (if available); other columns take
+    the value for the hour the segment starts in.
+    :param segments: dataframe of segments
+    :param weather: weather data indexed by UTC timestamp (see index_weather)
+    """
+    if 'timestamp_start' not in segments or weather.empty or segments.empty:
+        return segments
+    resolution = get_resolution(weather)
+    timestamps = pd.DatetimeIndex(
+        pd.to_datetime(segments['timestamp_start'], utc=True)
+    )
+    floor = timestamps.floor(resolution)
+    index = weather.index.to_numpy('datetime64[ns]')
+    floor_values = floor.tz_convert(None).to_numpy('datetime64[ns]')
+    last = len(index) - 1
+
+    idx = np.searchsorted(index, floor_values)
+    idx_clipped = np.minimum(idx, last)
+    found = (idx <= last) & (index[idx_clipped] == floor_values)
+
+    if resolution == RESOLUTIONS['hour']:
+        next_values = floor_values + np.timedelta64(resolution)
+        idx_next = np.minimum(np.searchsorted(index, next_values), last)
+        has_next = found & (index[idx_next] == next_values)
+        fraction = (timestamps - floor) / resolution
+        fraction = np.where(has_next, np.asarray(fraction, dtype=float), 0)
+    else:
+        has_next = np.zeros(len(segments), dtype=bool)
+
+    segments = segments.copy()
+    for col in weather.columns:
+        if col.startswith('Unnamed') or col == 'timestamp':
+            continue
+        column = weather[col]
+        values = pd.Series(column.to_numpy()[idx_clipped])
+        if has_next.any() and col not in DT_VARS and (
+            pd.api.types.is_numeric_dtype(column)
+        ):
+            values = values.astype(float)
+            diff = column.to_numpy(float)[idx_next] - values
+            if col == 'wind_direction':
+                # interpolate along the shortest arc
+                diff = (diff + 180) % 360 - 180
+            interpolated = values + diff * fraction
+            if col == 'wind_direction':
+                interpolated %= 360
+            values = values.where(~has_next, interpolated)
+        segments[col] = values.where(found).to_numpy()
+    return add_wind(segments)
+
+
+def add_wind(segments):
+    """Add true wind angle and headwind to segments dataframe"""
+    if 'wind_direction' not in segments:
+        return segments
+    wind_direction = pd.to_numeric(segments['wind_direction'], errors='coerce')
+    twa = (360 + (wind_direction - segments['heading'])) % 360
+    twa = twa.where(twa <= 180, twa - 360)
+    segments['twa'] = twa
+    segments['twa_rounded_abs'] = np.abs(10 * np.round(twa / 10))
+    if 'wind_speed' in segments:
+        wind_speed = pd.to_numeric(segments['wind_speed'], errors='coerce')
+        segments['headwind'] = wind_speed * np.cos(np.radians(twa))
+    return segments
+
+
+def get_dates(first, last):
+    """Return UTC dates for which weather data are needed for a ride from
+    first to last timestamp. The date before the first timestamp is
+    included if the ride starts in the first hour of the day, because KNMI
+    data for that hour are stored as hour 24 of the day before."""
+    first = pd.Timestamp(first)
+    last = pd.Timestamp(last)
+    if first.tz is not None:
+        first = first.tz_convert(None)
+    if last.tz is not None:
+        last = last.tz_convert(None)
+    return pd.date_range(
+        (first - pd.Timedelta(hours=1)).floor('D'), last.floor('D'), freq='D'
+    )
+
+
+class WeatherStore():
+    """Weather data for a set of rides, downloaded once per location and
+    date and kept in memory.
+
+    Each ride is matched to a location: the KNMI station or the oikolab grid
+    cell nearest to its median (or start) position. Pass the store to
+    BikeRide as path_weather to join its data to the segments; dates that
+    have not been downloaded yet are downloaded when needed.
+    """
+    def __init__(self, source='knmi', api_key=None, location='median',
+                 **kwargs):
+        """
+        :param source: source to get data from ('knmi' or 'oikolab')
+        :param api_key: api key for weather data provider (if applicable)
+        :param location: position of ride used to find the location,
+            'median' or 'start'
+        :param kwargs: parameters passed on to get_weather, e.g. cache_dir
+        """
+        self.source = source.lower()
+        if self.source not in ['knmi', 'oikolab']:
+            raise Exception(f'Weather source {source} not implemented')
+        self.api_key = api_key
+        self.location = location
+        self.kwargs = kwargs
+        self.frames = {}
+        self.fetched = set()
+
+
+    def get_locations(self, lats, lons):
+        """Return (lat, lon) of the location used for each position"""
+        if self.source == 'knmi':
+            stations = nearest_stations(lats, lons)
+            return list(zip(stations.lat, stations.lon))
+        return [(snap(lat), snap(lon)) for lat, lon in zip(lats, lons)]
+
+
+    def get_position(self, ride):
+        """Return tuple (lat, lon, first timestamp, last timestamp) for ride,
+        or None if it has no timestamps."""
+        track = ride.track
+        if not len(track) or 'timestamp' not in track:
+            return None
+        timestamps = track['timestamp']
+        timestamps = timestamps[~np.isnat(timestamps)]
+        if not len(timestamps):
+            return None
+        if self.location == 'start':
+            lat, lon = track['lat'][0], track['lon'][0]
+        else:
+            lat, lon = ride.median_position
+        return lat, lon, timestamps.min(), timestamps.max()
+
+
+    def plan(self, rides):
+        """Return dataframe with the distinct locations and dates for which
+        weather data are needed, with columns source, lat, lon, date and
+        fetched.
+
+        :param rides: BikeRide objects, or tuples (lat, lon, first
+            timestamp, last timestamp), e.g. from ride summaries
+        """
+        positions = [
+            ride if isinstance(ride, tuple) else self.get_position(ride)
+            for ride in rides
+        ]
+        positions = [position for position in positions if position]
+        rows = set()
+        if positions:
+            lats, lons, firsts, lasts = zip(*positions)
+            locations = self.get_locations(lats, lons)
+            for location, first, last in zip(locations, firsts, lasts):
+                for date in get_dates(first, last):
+                    rows.add((*location, date))
+        plan = pd.DataFrame(sorted(rows), columns=['lat', 'lon', 'date'])
+        plan.insert(0, 'source', self.source)
+        plan['fetched'] = [
+            ((lat, lon), date) in self.fetched
+            for lat, lon, date in zip(plan.lat, plan.lon, plan.date)
+        ]
+        return plan
+
+
+    def fetch(self, plan):
+        """Download weather data for the rows of plan that have not been
+        fetched yet, with one call to get_weather per location and range of
+        consecutive dates."""
+        plan = plan[~plan.fetched]
+        for (lat, lon), group in plan.groupby(['lat', 'lon']):
+            for first, last in split_days(sorted(group.date), math.inf):
+                weather = get_weather(
+                    self.source, lat, lon, f'{first:%Y%m%d}', f'{last:%Y%m%d}',
+                    api_key=self.api_key, **self.kwargs
+                )
+                self.add((lat, lon), weather)
+                self.fetched.update(
+                    ((lat, lon), date)
+                    for date in pd.date_range(first, last, freq='D')
+                )
+
+
+    def split(self, positions):
+        """Return list with for each position (see get_position, or None) a
+        copy of the store with only the data for its location, e.g. to send
+        to worker processes. The copies share the dataframes of the store.
+        """
+        found = [position for position in positions if position]
+        locations = iter(self.get_locations(
+            [position[0] for position in found],
+            [position[1] for position in found],
+        ) if found else [])
+        fetched = {}
+        for location, date in self.fetched:
+            fetched.setdefault(location, set()).add((location, date))
+        stores = []
+        for position in positions:
+            location = next(locations) if position else None
+            store = copy.copy(self)
+            store.frames = {
+                location: self.frames[location]
+            } if location in self.frames else {}
+            store.fetched = set(fetched.get(location, ()))
+            stores.append(store)
+        return stores
+
+
+    def add(self, location, weather):
+        """Add weather data for location"""
+        if weather is None or weather.empty:
+            return
+        weather = index_weather(weather)
+        if location in self.frames:
+            weather = pd.concat([self.frames[location], weather])
+            weather = weather[~weather.index.duplicated(keep='last')]
+            weather = weather.sort_index(kind='stable')
+        self.frames[location] = weather
+
+
+    def get_ride_weather(self, ride):
+        """Return weather data, indexed by UTC timestamp, for the location of
+        ride, or None if there are none. Missing dates are downloaded."""
+        position = self.get_position(ride)
+        if position is None:
+            return None
+        self.fetch(self.plan([position]))
+        location = self.get_locations([position[0]], [position[1]])[0]
+        return self.frames.get(location)
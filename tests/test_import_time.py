@@ -0,0 +1,20 @@
+"""Check the import time budget of bikeride (see benchmarks/import_time.py)"""
+
+from pathlib import Path
+import sys
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'benchmarks'))
+import import_time
+
+
+@pytest.mark.parametrize(
+    'check', import_time.CHECKS, ids=[c['statement'] for c in import_time.CHECKS]
+)
+def test_import_time(check):
+    seconds, loaded = import_time.measure(check)
+    assert not loaded, f'{check["statement"]} imported {", ".join(loaded)}'
+    assert seconds <= check['budget'], (
+        f'{check["statement"]} took {seconds:.3f} s; budget is '
+        f'{check["budget"]} s'
+    )